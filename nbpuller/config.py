@@ -44,6 +44,10 @@ class Config(object):
     # Default domain to pull from is Github
     DEFAULT_DOMAIN = GITHUB_DOMAIN
 
+    # Scheme of git remote urls. With 'file', domains are local directories
+    # holding bare repos, which is what tests/benchmark.py uses.
+    GIT_URL_SCHEME = os.environ.get('GIT_URL_SCHEME', default='https')
+
     # A list of domain that can pull from, delimited by DELIMITER
     ALLOWED_WEB_DOMAINS = os.environ.get(
         'ALLOWED_WEB_DOMAINS', default=GITHUB_DOMAIN).split(DELIMITER)
@@ -66,6 +70,117 @@ class Config(object):
 
     ALLOWED_URL_DOMAIN = []
 
+    # Directory holding one bare mirror per remote repo, shared by every user
+    # clone on the host through git alternates. Empty disables the cache.
+    GIT_CACHE_PATH = os.environ.get('GIT_CACHE_PATH', default='')
+
+    # How new repos are cloned from the remote: 'full', 'blobless' (partial
+    # clone without blobs) or 'shallow' (blobless with only the last commit)
+    GIT_CLONE_MODE = os.environ.get('GIT_CLONE_MODE', default='full')
+
+    # How pulls read git objects: 'cli' runs git, 'pygit2' reads them in
+    # process (see git_backend.py)
+    GIT_BACKEND = os.environ.get('GIT_BACKEND', default='cli')
+
+    # Untracked files larger than WIP_MAX_FILE_BYTES, matching one of the
+    # WIP_EXCLUDE globs (delimited by DELIMITER), or past the first
+    # WIP_BYTE_BUDGET bytes of untracked files in a pull are left out of WIP
+    # commits. 0 disables either limit.
+    WIP_MAX_FILE_BYTES = int(os.environ.get(
+        'WIP_MAX_FILE_BYTES', default=20 * 1024 * 1024))
+    WIP_BYTE_BUDGET = int(os.environ.get(
+        'WIP_BYTE_BUDGET', default=100 * 1024 * 1024))
+    WIP_EXCLUDE = [pattern for pattern in os.environ.get(
+        'WIP_EXCLUDE', default='').split(DELIMITER) if pattern]
+
+    # Files of at least DEDUP_MIN_BYTES checked out unchanged from upstream are
+    # shared between users through DEDUP_STORE_PATH, which must be on the
+    # same file system as their repos (see dedup.py). DEDUP_MODE is
+    # 'hardlink', 'reflink' or empty to disable it.
+    DEDUP_MODE = os.environ.get('DEDUP_MODE', default='')
+    DEDUP_STORE_PATH = os.environ.get('DEDUP_STORE_PATH', default='')
+    DEDUP_MIN_BYTES = int(os.environ.get(
+        'DEDUP_MIN_BYTES', default=1024 * 1024))
+    # File extensions that 'hardlink' shares, delimited by DELIMITER. Writing
+    # into a shared file fails, and Jupyter and plotting libraries write
+    # into files in place, so nothing users may save over should be listed.
+    DEDUP_HARDLINK_TYPES = os.environ.get(
+        'DEDUP_HARDLINK_TYPES',
+        default='pdf:zip:gz:parquet:feather:h5:npy:npz',
+    ).split(DELIMITER)
+
+    # Seconds during which the last seen commit of a remote branch is trusted
+    # without asking the remote again. Pulls then miss upstream changes
+    # pushed within that time, so this is off (0, always fetch) by default.
+    REMOTE_FRESHNESS_TTL_S = int(
+        os.environ.get('REMOTE_FRESHNESS_TTL_S', default=0))
+    # Seconds after which a git ls-remote checking whether a remote branch
+    # moved is killed, and the pull fetches anyway
+    REMOTE_CHECK_TIMEOUT_S = int(
+        os.environ.get('REMOTE_CHECK_TIMEOUT_S', default=10))
+
+    # Token admins send as "Authorization: Bearer <token>" to
+    # /interact/prewarm. Empty disables the endpoint.
+    PREWARM_TOKEN = os.environ.get('PREWARM_TOKEN', default='')
+
+    # Token Prometheus sends as "Authorization: Bearer <token>" to
+    # /interact/metrics. Empty disables the endpoint.
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', default='')
+
+    # Background maintenance of the repos pulled by this server (see
+    # maintenance.py). Every MAINTENANCE_INTERVAL_S seconds, while no pull is
+    # waiting, one repo is maintained that hasn't been pulled for
+    # MAINTENANCE_IDLE_S nor maintained for MAINTENANCE_MIN_AGE_S seconds.
+    # 0 disables it.
+    MAINTENANCE_INTERVAL_S = int(
+        os.environ.get('MAINTENANCE_INTERVAL_S', default=0))
+    MAINTENANCE_IDLE_S = int(os.environ.get('MAINTENANCE_IDLE_S', default=600))
+    MAINTENANCE_MIN_AGE_S = int(
+        os.environ.get('MAINTENANCE_MIN_AGE_S', default=24 * 60 * 60))
+    # Unreachable objects younger than this are kept, as for git prune
+    MAINTENANCE_PRUNE_EXPIRE = os.environ.get(
+        'MAINTENANCE_PRUNE_EXPIRE', default='2.weeks.ago')
+
+    # Number of threads running pulls and downloads
+    PULL_WORKERS = int(os.environ.get('PULL_WORKERS', default=4))
+
+    # How many requests may wait for a worker before new ones are turned
+    # away, and how many seconds those are asked to wait before retrying
+    PULL_QUEUE_DEPTH = int(os.environ.get('PULL_QUEUE_DEPTH', default=100))
+    BUSY_RETRY_S = int(os.environ.get('BUSY_RETRY_S', default=30))
+
+    # Threads checking whether an interact link can redirect right away. When
+    # they are all busy, the landing page goes straight to the progress page.
+    REDIRECT_CHECK_WORKERS = int(
+        os.environ.get('REDIRECT_CHECK_WORKERS', default=4))
+
+    # Seconds between queue position updates sent to waiting clients
+    QUEUE_STATUS_INTERVAL_S = 2
+
+    # Log the timing summary of every request as a JSON record
+    TRACE_LOG = bool(os.environ.get('TRACE_LOG', default=''))
+
+    # Maximum number of git progress messages sent per second to each client
+    PROGRESS_MAX_RATE = int(os.environ.get('PROGRESS_MAX_RATE', default=5))
+
+    # Largest file that can be downloaded with file_url, 0 for no limit
+    MAX_DOWNLOAD_BYTES = int(os.environ.get(
+        'MAX_DOWNLOAD_BYTES', default=200 * 1024 * 1024))
+
+    # Downloads run on the IOLoop. At most MAX_DOWNLOADS run at once, and at
+    # most DOWNLOADS_PER_DOMAIN of them from the same domain.
+    MAX_DOWNLOADS = int(os.environ.get('MAX_DOWNLOADS', default=20))
+    DOWNLOADS_PER_DOMAIN = int(os.environ.get(
+        'DOWNLOADS_PER_DOMAIN', default=4))
+    DOWNLOAD_CONNECT_TIMEOUT_S = 10
+    DOWNLOAD_TIMEOUT_S = int(os.environ.get('DOWNLOAD_TIMEOUT_S', default=300))
+
+    # Directory of the host-level cache for file_url downloads, shared by all
+    # users. Empty disables the cache. Cached files are used without asking
+    # the origin for FILE_CACHE_TTL_S seconds, then revalidated.
+    FILE_CACHE_PATH = os.environ.get('FILE_CACHE_PATH', default='')
+    FILE_CACHE_TTL_S = int(os.environ.get('FILE_CACHE_TTL_S', default=300))
+
     def __getitem__(self, attr):
         """
         Temporary hack in order to maintain Flask config-like config usage.
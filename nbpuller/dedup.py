@@ -0,0 +1,267 @@
+"""
+Shares large data files between the checkouts of different users.
+
+Labs often ship the same CSVs and images to every student. With DEDUP_MODE
+and DEDUP_STORE_PATH set, each file of at least DEDUP_MIN_BYTES that a pull
+checked out unchanged from upstream is swapped for a link to a single copy
+in the store, named by the file's git blob id:
+
+    hardlink  The file becomes a hard link to the stored copy, which is
+              read-only and owned by the server. This needs the server to
+              run as root: otherwise the first user to pull a file would own
+              it, so reflink is used instead. Writing into a shared file
+              fails rather than giving the user a private copy, and Jupyter
+              saves files by writing into them in place, so only files with
+              one of the DEDUP_HARDLINK_TYPES extensions, which Jupyter
+              doesn't edit, are shared this way.
+    reflink   The file becomes a reflink of the stored copy (on btrfs or
+              XFS), which the file system copies on write, so users can edit
+              it any way they like.
+
+Git still writes each file once when checking it out; deduplication then
+frees its blocks. The store must be on the same file system as the users'
+repos. Files the user changed, including those kept by a WIP merge, are
+never stored, since only blobs that are on the upstream branch qualify.
+
+Stored files are copies made by the server, never a user's own file. One
+that isn't a read-only file of the right size owned by the server is
+replaced before anything links to it, so nobody else who can write to the
+store can change what users get.
+"""
+import os
+import stat
+import threading
+
+from . import sparse_checkout
+from . import util
+
+MODES = ['', 'hardlink', 'reflink']
+
+# Suffix of the link made next to a file before it replaces the file
+TMP_SUFFIX = '.nbpuller-dedup'
+
+# Whether the fallback from hardlink to reflink was logged
+_warned_not_root = False
+
+
+def dedup_checkout(repo, branch_name, paths, changed_paths, config):
+    """
+    Shares the large files under paths that are the same as on
+    origin/<branch_name>. Only files written by this pull are looked at:
+    those in changed_paths (files or directories), or every file if it is
+    None.
+
+    Returns the paths of the files that were shared.
+    """
+    mode = config['DEDUP_MODE']
+    store = config['DEDUP_STORE_PATH']
+    if mode not in MODES:
+        raise ValueError('Unknown DEDUP_MODE: {}'.format(mode))
+    if not mode or not store:
+        return []
+    if mode == 'hardlink' and os.geteuid() != 0:
+        _warn_not_root()
+        mode = 'reflink'
+
+    # ls-tree doesn't expand patterns
+    paths = [path for path in paths
+             if not sparse_checkout.GLOB_CHARS & set(path)]
+    if not paths or changed_paths == []:
+        return []
+
+    candidates = _upstream_blobs(repo, branch_name, paths,
+                                 config['DEDUP_MIN_BYTES'])
+    if mode == 'hardlink':
+        suffixes = tuple('.' + extension.lower()
+                         for extension in config['DEDUP_HARDLINK_TYPES']
+                         if extension)
+        candidates = {path: blob for path, blob in candidates.items()
+                      if path.lower().endswith(suffixes)}
+    if changed_paths is not None:
+        written = {path.strip('/') for path in changed_paths}
+        candidates = {path: blob for path, blob in candidates.items()
+                      if _within(path, written)}
+    if not candidates:
+        return []
+
+    # A WIP merge may have kept the user's version instead
+    staged = _index_blobs(repo, paths)
+
+    shared = []
+    for path, (sha, size) in sorted(candidates.items()):
+        if staged.get(path) != sha:
+            continue
+
+        target = os.path.join(repo.working_tree_dir, path)
+        try:
+            info = os.lstat(target)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(info.st_mode) or info.st_size != size or \
+                info.st_nlink > 1:
+            continue
+
+        stored = os.path.join(store, sha[:2], sha[2:])
+        try:
+            if not _share(mode, stored, target, size):
+                util.logger.warning(
+                    "Can't reflink {} to {}, not deduplicating".format(
+                        target, store))
+                break
+        except OSError as e:
+            util.logger.warning('Not deduplicating {}: {}'.format(target, e))
+            break
+        shared.append(path)
+
+    if shared:
+        if mode == 'hardlink':
+            _ignore_shared_stat(repo)
+        # The files have new inodes and times, so the index is refreshed now
+        # rather than by the next git status
+        repo.git.update_index('-q', '--refresh')
+        util.logger.info('Deduplicated {} files'.format(len(shared)))
+
+    return shared
+
+
+def _upstream_blobs(repo, branch_name, paths, min_bytes):
+    """
+    Returns {path: (blob sha, size)} of the regular, non-executable files
+    under paths on origin/<branch_name> with at least min_bytes.
+    """
+    output = repo.git.ls_tree('-r', '-l', '-z', 'origin/' + branch_name,
+                              '--', *paths)
+    blobs = {}
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info, _, path = entry.partition('\t')
+        mode, _, sha, size = info.split()
+        if mode == '100644' and int(size) >= min_bytes:
+            blobs[path] = (sha, int(size))
+    return blobs
+
+
+def _index_blobs(repo, paths):
+    """Returns {path: blob sha} of the stage 0 index entries under paths."""
+    output = repo.git.ls_files('-s', '-z', '--', *paths)
+    blobs = {}
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info, _, path = entry.partition('\t')
+        _, sha, stage = info.split()
+        if stage == '0':
+            blobs[path] = sha
+    return blobs
+
+
+def _within(path, written):
+    """Returns whether path or a directory containing it is in written."""
+    while path:
+        if path in written:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def _warn_not_root():
+    global _warned_not_root
+    if not _warned_not_root:
+        util.logger.warning(
+            'DEDUP_MODE hardlink needs the server to run as root, so that '
+            'users don\'t own the shared files. Using reflink instead.')
+        _warned_not_root = True
+
+
+def _share(mode, stored, target, size):
+    """
+    Replaces target, a file of size bytes, by a link to stored. If nothing
+    trustworthy is stored yet, a copy of target is stored first.
+
+    Returns False if the file system can't reflink.
+    """
+    os.makedirs(os.path.dirname(stored), exist_ok=True)
+    if not _is_trusted(stored, size):
+        if not _store(mode, target, stored):
+            return False
+        if mode == 'reflink':
+            # target already shares its blocks with the stored copy
+            return True
+
+    tmp_path = target + TMP_SUFFIX
+    _remove(tmp_path)
+    if mode == 'hardlink':
+        os.link(stored, tmp_path)
+    elif not util.clone_file(stored, tmp_path):
+        os.unlink(tmp_path)
+        return False
+
+    os.replace(tmp_path, target)
+    return True
+
+
+def _is_trusted(stored, size):
+    """
+    Returns whether stored is a regular file of size bytes that only the
+    server could have written: owned by it and read-only.
+    """
+    try:
+        info = os.lstat(stored)
+    except FileNotFoundError:
+        return False
+    if stat.S_ISREG(info.st_mode) and info.st_size == size and \
+            info.st_uid == os.geteuid() and not info.st_mode & 0o222:
+        return True
+    util.logger.warning('Replacing untrusted {} in the dedup store'.format(
+        stored))
+    return False
+
+
+def _store(mode, target, stored):
+    """
+    Stores a read-only copy of target as stored, replacing anything there.
+    In reflink mode, the copy has to be a reflink.
+
+    Returns False if nothing was stored since the file system can't reflink.
+    """
+    # Other pulls may be storing the same blob
+    store_tmp = '{}.{}.{}{}'.format(
+        stored, os.getpid(), threading.get_ident(), TMP_SUFFIX)
+    try:
+        if not util.clone_file(target, store_tmp) and mode == 'reflink':
+            os.unlink(store_tmp)
+            return False
+        os.chmod(store_tmp, 0o444)
+        os.replace(store_tmp, stored)
+    except BaseException:
+        _remove(store_tmp)
+        raise
+    return True
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _ignore_shared_stat(repo):
+    """
+    Makes git only compare the mtime and size of files with the index. The
+    owner, inode and ctime of hard linked files change whenever another user
+    links them, which would have git hash them again.
+    """
+    reader = repo.config_reader(config_level='repository')
+    try:
+        done = reader.get_value('core', 'checkStat', '') == 'minimal'
+    finally:
+        reader.release()
+    if done:
+        return
+
+    repo_config = repo.config_writer()
+    repo_config.set_value('core', 'checkStat', 'minimal')
+    repo_config.set_value('core', 'trustCtime', False)
+    repo_config.release()
@@ -1,73 +1,124 @@
 import os
-from urllib.error import HTTPError
-from urllib.request import urlopen
+import tempfile
 import urllib.parse as urlparse
 
+from tornado import gen
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
 from . import util
 from . import messages
+from . import metrics
+from . import tracing
+from .http_cache import CacheEntry
+
+try:
+    # curl keeps connections to origins open between downloads, tornado's
+    # own client opens a new one every time.
+    import pycurl  # noqa: F401
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as _client_class
+except ImportError:
+    from tornado.simple_httpclient import \
+        SimpleAsyncHTTPClient as _client_class
+
+# Seconds between attempts to lock a cache entry in use by another download
+CACHE_LOCK_POLL_S = 0.1
 
+# Created on first use, since they belong to the running IOLoop
+_http_client = None
+_domain_semaphores = {}
 
+
+@gen.coroutine
 def download_file_and_redirect(**kwargs):
     """
     Downloads the file from file_url and saves it into the COPY_PATH in config.
 
-    Must be called with username, file_url, config keyword args.
+    Must be called with username, file_url, config keyword args. An optional
+    progress (git_progress.Progress) receives the number of bytes downloaded.
+
+    This is a coroutine running on the IOLoop; the download itself never
+    blocks a thread.
 
-    Returns a message from messages.py.
+    Returns a message from messages.py, with a 'timing' summary of the
+    download from tracing.py.
     """
     username = kwargs['username']
     file_url = kwargs['file_url']
     config = kwargs['config']
+    progress = kwargs.get('progress')
 
     assert username and file_url and config
 
+    trace = tracing.Trace('download')
+    util.logger.info('({}) Downloading {} (request {})'.format(
+        username, file_url, trace.request_id))
+
     try:
-        file_contents = _get_remote_file(config, file_url)
+        _check_allowed_domain(config, file_url)
         destination = os.path.basename(file_url)
         path = util.construct_path(config['COPY_PATH'], locals())
 
         # destination might change if the file results in a copy
-        destination = _write_to_destination(
-            file_contents, path, destination, config)
-        util.chown(path, destination)
+        destination = _choose_destination(path, destination, config)
+
+        # make user directory if it doesn't exist
+        os.makedirs(path, exist_ok=True)
+
+        target = os.path.join(path, destination)
+        if config['FILE_CACHE_PATH']:
+            cache = yield _download_cached(config, file_url, target, trace,
+                                           progress=progress)
+        else:
+            yield _download(config, file_url, target, trace,
+                            progress=progress)
+            cache = None
+        with trace.span('chown'):
+            util.chown(path, destination)
 
         redirect_url = util.construct_path(config['FILE_REDIRECT_PATH'], {
             'username': username,
             'destination': destination,
         })
 
-        util.logger.info('({}) pulled file: {}'.format(username, file_url))
-        return messages.redirect(redirect_url)
+        util.logger.info('({}) pulled file: {} (cache: {})'.format(
+            username, file_url, cache))
+        return trace.attach(
+            messages.redirect({'url': redirect_url, 'cache': cache}), config)
 
-    except HTTPError:
+    except HTTPClientError:
+        metrics.ERRORS.inc('download', 'HTTPClientError')
         error = ('Source file "{}" does not exist or is not accessible.'
                  .format(file_url))
         util.logger.exception(error)
-        return messages.error({
+        return trace.attach(messages.error({
             'message': error,
             'proceed_url': config['ERROR_REDIRECT_URL']
-        })
+        }), config)
     except Exception as e:
+        metrics.ERRORS.inc('download', type(e).__name__)
         error = ('Unhandled error: {}'.format(e))
         util.logger.exception(error)
-        return messages.error({
+        return trace.attach(messages.error({
             'message': error,
             'proceed_url': config['ERROR_REDIRECT_URL']
-        })
+        }), config)
 
 
-def _get_remote_file(config, source):
-    """Fetches file, throws an HTTPError if the file is not accessible."""
+def _check_allowed_domain(config, source):
+    """Raises a ValueError if source is not from an allowed domain."""
     url_components = urlparse.urlparse(source)
 
     if url_components.netloc not in config['ALLOWED_URL_DOMAIN']:
         raise ValueError('File not from allowed domain')
 
-    return urlopen(source).read().decode('utf-8')
-
 
-def _write_to_destination(file_contents, path, destination, config):
-    """Write file to destination on server."""
+def _choose_destination(path, destination, config):
+    """
+    Returns the file name to save to in path, adding -copy suffixes until it
+    doesn't clash with an existing file.
+    """
 
     # check that this filetype is allowed (ideally, not an executable)
     file_type = destination.split('.')[-1]
@@ -78,13 +129,169 @@ def _write_to_destination(file_contents, path, destination, config):
         root = destination.rsplit('.', 1)[0]
         suffix = destination.split('.')[-1]
         destination = '{}-copy.{}'.format(root, suffix)
-        return _write_to_destination(file_contents, path, destination, config)
+        return _choose_destination(path, destination, config)
 
-    # make user directory if it doesn't exist
-    os.makedirs(path, exist_ok=True)
+    return destination
 
-    # write the file
-    with open(os.path.join(path, destination), 'wb') as outfile:
-        outfile.write(file_contents.encode('utf-8'))
 
-    return destination
+@gen.coroutine
+def _download_cached(config, source, target, trace, progress=None):
+    """
+    Copies source to target through the host-level cache in FILE_CACHE_PATH,
+    downloading it only if the cached copy is missing or changed upstream.
+
+    Returns 'hit' if the cached copy was used and 'miss' if it was downloaded.
+    """
+    io_loop = IOLoop.current()
+    entry = CacheEntry(config['FILE_CACHE_PATH'], source)
+
+    # Poll instead of blocking an executor thread, which tornado also needs
+    # for resolving host names.
+    while not entry.acquire(blocking=False):
+        yield gen.sleep(CACHE_LOCK_POLL_S)
+    try:
+        if entry.is_fresh(config['FILE_CACHE_TTL_S']):
+            cache = 'hit'
+        else:
+            response = yield _download(config, source, entry.body_path,
+                                       trace, progress=progress,
+                                       request_headers=entry.validators())
+            if response.code == 304:
+                entry.revalidated()
+                cache = 'hit'
+            else:
+                entry.stored(response.headers)
+                cache = 'miss'
+
+        # Copy next to target first so target never holds a partial file
+        with trace.span('copy'):
+            yield io_loop.run_in_executor(
+                None, _copy_atomically, entry.body_path, target)
+    finally:
+        entry.release()
+
+    return cache
+
+
+def _copy_atomically(source, target):
+    tmp_path = '{}.{}.part'.format(target, os.getpid())
+    try:
+        util.clone_file(source, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+@gen.coroutine
+def _download(config, source, target, trace, progress=None,
+              request_headers=None):
+    """
+    Streams source into the file target as the chunks arrive, recording the
+    transfer as the 'fetch' span of trace.
+
+    The data goes to a temporary file in the same directory that is renamed
+    to target once complete, so target never holds a partial download.
+
+    At most MAX_DOWNLOADS downloads run at once, and at most
+    DOWNLOADS_PER_DOMAIN of those from one domain; the others wait here.
+
+    Throws an HTTPClientError if the file is not accessible and a ValueError
+    if it is larger than MAX_DOWNLOAD_BYTES, which is checked against
+    Content-Length before the body arrives when the server sends it.
+
+    Returns the response. For a conditional request that is a 304 response,
+    in which case target is left untouched.
+    """
+    max_bytes = config['MAX_DOWNLOAD_BYTES']
+    too_large = 'File is larger than {} bytes'.format(max_bytes)
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(target),
+        prefix='.{}.'.format(os.path.basename(target)),
+        suffix='.part',
+    )
+    # mkstemp creates files only readable by us
+    os.fchmod(fd, 0o644)
+    tmp_file = os.fdopen(fd, 'wb')
+
+    # The callbacks can't return errors, so they record them here
+    state = {'total': None, 'received': 0, 'error': None}
+
+    def on_header(line):
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            state['total'] = int(value.strip())
+            if max_bytes and state['total'] > max_bytes:
+                state['error'] = ValueError(too_large)
+                raise state['error']
+
+    def on_chunk(chunk):
+        state['received'] += len(chunk)
+        if max_bytes and state['received'] > max_bytes:
+            state['error'] = ValueError(too_large)
+            raise state['error']
+
+        tmp_file.write(chunk)
+        trace.add_bytes(len(chunk))
+        if progress:
+            progress.download(state['received'], state['total'])
+
+    request = HTTPRequest(
+        source,
+        headers=request_headers,
+        header_callback=on_header,
+        streaming_callback=on_chunk,
+        connect_timeout=config['DOWNLOAD_CONNECT_TIMEOUT_S'],
+        request_timeout=config['DOWNLOAD_TIMEOUT_S'],
+    )
+
+    try:
+        with (yield _domain_semaphore(config, source).acquire()):
+            try:
+                with trace.span('fetch'):
+                    response = yield _get_http_client(config).fetch(
+                        request, raise_error=False)
+            except Exception:
+                if state['error'] is not None:
+                    raise state['error']
+                raise
+            # The client may also turn callback errors into a 599 response
+            if state['error'] is not None:
+                raise state['error']
+
+        tmp_file.close()
+        if response.code == 304 and request_headers:
+            os.unlink(tmp_path)
+            return response
+        response.rethrow()
+
+        os.replace(tmp_path, target)
+        return response
+    except BaseException:
+        tmp_file.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _get_http_client(config):
+    global _http_client
+    if _http_client is None:
+        if _client_class.__name__ == 'SimpleAsyncHTTPClient':
+            util.logger.warning(
+                'pycurl is not installed, so every file_url download opens a '
+                'new connection. Install nbpuller[curl] to reuse them.')
+        _http_client = _client_class(
+            force_instance=True,
+            max_clients=config['MAX_DOWNLOADS'],
+        )
+    return _http_client
+
+
+def _domain_semaphore(config, source):
+    netloc = urlparse.urlparse(source).netloc
+    if netloc not in _domain_semaphores:
+        _domain_semaphores[netloc] = Semaphore(config['DOWNLOADS_PER_DOMAIN'])
+    return _domain_semaphores[netloc]
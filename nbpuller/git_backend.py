@@ -0,0 +1,161 @@
+"""
+Backends for the git operations of a pull that only read the object
+database: checking which paths exist in a commit, finding how commits are
+related and listing the files that differ between two commits.
+
+GIT_BACKEND selects the backend. 'cli' (the default) runs git through
+GitPython like every other step of a pull. 'pygit2' reads the objects in
+process with libgit2 and saves the git cat-file and git diff subprocesses of
+each pull. It needs the optional pygit2 package.
+
+Operations that write to the working tree (checkout, merge -Xours,
+read-tree, status) always use the git CLI, since libgit2 doesn't honor
+sparse checkout.
+"""
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+import git
+
+BACKENDS = ['cli', 'pygit2']
+
+
+def open_backend(config, repo):
+    """
+    Returns the backend chosen by GIT_BACKEND for repo (a git.Repo). It must
+    be closed when done.
+    """
+    name = config['GIT_BACKEND']
+    if name == 'cli':
+        return CliBackend(repo)
+    if name == 'pygit2':
+        if pygit2 is None:
+            raise ValueError('GIT_BACKEND pygit2 needs the pygit2 package')
+        return Pygit2Backend(repo)
+    raise ValueError('Unknown GIT_BACKEND: {}'.format(name))
+
+
+class CliBackend(object):
+    """Reads objects with git subprocesses through GitPython."""
+    def __init__(self, repo):
+        self.repo = repo
+
+    def object_types(self, rev, paths):
+        """
+        Returns a dict mapping each of paths to its object type ('blob',
+        'tree') in the commit rev, or None if it doesn't exist there.
+
+        All lookups go through a single git cat-file --batch-check session,
+        which GitPython keeps open on the repo until repo.close() is called.
+        """
+        found = {}
+        for path in paths:
+            # A newline would end the batch request early
+            if '\n' in path:
+                found[path] = None
+                continue
+
+            try:
+                _, object_type, _ = self.repo.git.get_object_header(
+                    rev + ':' + path)
+                found[path] = object_type.decode('ascii')
+            except ValueError:
+                found[path] = None
+
+        return found
+
+    def contains(self, sha, ancestor_sha):
+        """
+        Returns whether the commit sha is ancestor_sha or has it in its
+        history. False if either is missing from the repo.
+        """
+        if sha == ancestor_sha:
+            return True
+        try:
+            self.repo.git.merge_base('--is-ancestor', ancestor_sha, sha)
+            return True
+        except git.exc.GitCommandError:
+            return False
+
+    def merge_base(self, sha, other_sha):
+        """
+        Returns the best common ancestor of two commits, or None if they
+        have none or either is missing from the repo.
+        """
+        try:
+            return self.repo.git.merge_base(sha, other_sha).strip() or None
+        except git.exc.GitCommandError:
+            return None
+
+    def changed_paths(self, old_sha, new_sha):
+        """Returns the paths of the files that differ between two commits."""
+        if old_sha == new_sha:
+            return []
+        output = self.repo.git.diff('--name-only', '--no-renames', '-z',
+                                    old_sha, new_sha)
+        return [path for path in output.split('\0') if path]
+
+    def close(self):
+        # The cat-file session is stopped by repo.close()
+        pass
+
+
+class Pygit2Backend(object):
+    """
+    Reads objects in process with libgit2. Objects borrowed from a mirror
+    through alternates are found too.
+    """
+    def __init__(self, repo):
+        self._repository = pygit2.Repository(repo.git_dir)
+
+    def object_types(self, rev, paths):
+        try:
+            tree = self._repository.revparse_single(rev).peel(pygit2.Tree)
+        except (KeyError, ValueError):
+            return {path: None for path in paths}
+
+        found = {}
+        for path in paths:
+            # Like <rev>: for git, the empty path is the root tree
+            if not path:
+                found[path] = 'tree'
+                continue
+
+            # git accepts trailing slashes on directories, libgit2 doesn't
+            name = path.rstrip('/')
+            try:
+                entry = tree[name] if name else None
+            except (KeyError, ValueError):
+                entry = None
+            found[path] = entry.type_str if entry is not None else None
+        return found
+
+    def contains(self, sha, ancestor_sha):
+        if sha == ancestor_sha:
+            return True
+        try:
+            return self._repository.descendant_of(sha, ancestor_sha)
+        except (KeyError, ValueError, pygit2.GitError):
+            return False
+
+    def merge_base(self, sha, other_sha):
+        try:
+            base = self._repository.merge_base(sha, other_sha)
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+        return str(base) if base is not None else None
+
+    def changed_paths(self, old_sha, new_sha):
+        if old_sha == new_sha:
+            return []
+        diff = self._repository.diff(old_sha, new_sha)
+        paths = set()
+        for delta in diff.deltas:
+            paths.add(delta.old_file.path)
+            paths.add(delta.new_file.path)
+        return sorted(paths)
+
+    def close(self):
+        self._repository.free()
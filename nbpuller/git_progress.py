@@ -1,42 +1,160 @@
-from collections import deque
+import re
+import threading
 
 import git
 
 from . import util
 from . import messages
 
+# Phase names for the stage bits of RemoteProgress op codes
+PHASES = {
+    git.RemoteProgress.COUNTING: 'Counting objects',
+    git.RemoteProgress.COMPRESSING: 'Compressing objects',
+    git.RemoteProgress.WRITING: 'Writing objects',
+    git.RemoteProgress.RECEIVING: 'Receiving objects',
+    git.RemoteProgress.RESOLVING: 'Resolving deltas',
+    git.RemoteProgress.FINDING_SOURCES: 'Finding sources',
+    git.RemoteProgress.CHECKING_OUT: 'Checking out files',
+}
+
+# The amount git received, eg. ", 1.20 MiB | 2.00 MiB/s, done."
+RECEIVED_REGEX = re.compile(r'([\d.]+) (bytes|KiB|MiB|GiB)')
+UNITS = {'bytes': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30}
+
 
 class Progress(git.RemoteProgress):
     """
     Subclass of git.RemoteProgress that is initialized with a callback that
-    gets called each time it gets an update.
+    gets called with progress updates. It also reports file downloads through
+    download().
+
+    git reports progress on the worker thread, often thousands of times per
+    clone. Updates are coalesced and the callback is called on io_loop at most
+    max_rate times per second, with a progress message whose payload has:
+
+        lines: lines finished since the previous message
+        current: the line currently being updated, if any
+        phase: name of the current git phase, eg. 'Receiving objects'
+        percent: completion of that phase, if git knows it
+
+    Without an io_loop the callback is called directly on every update.
 
-    The callback is called with a log message object with the current lines as
-    the payload.
+    If trace (a tracing.Trace) is set, the bytes git received are added to it.
+
+    close() must be called on io_loop once the final message was sent, so that
+    no progress is sent after it.
 
     We define a callback in the RequestHandler to emit updates to the socket.
     """
-    def __init__(self, username, callback, max_lines=10):
+    def __init__(self, username, callback, io_loop=None, max_rate=5):
         git.RemoteProgress.__init__(self)
-        self.lines = deque(maxlen=max_lines)
         self.username = username
         self.callback = callback
+        self.io_loop = io_loop
+        self.interval = 1.0 / max_rate
+        self.trace = None
 
-    def _create_message(self):
-        lines = list(self.lines)
-        return messages.log('\n'.join(lines))
+        self._lock = threading.Lock()
+        self._lines = []
+        self._current = None
+        self._phase = None
+        self._percent = None
+        self._flush_scheduled = False
+        self._last_flush = 0
+        self._timeout = None
+        self._closed = False
 
     def line_dropped(self, line):
         util.logger.info('({}) {}'.format(self.username, line))
-        self.lines.append(line)
-        self.callback(self._create_message())
+        with self._lock:
+            self._lines.append(line)
+        self._request_flush()
 
-    def update(self, *args):
+    def update(self, op_code, cur_count, max_count=None, message=''):
         # The docs say:
         #
         #     You may read the contents of the current line in self._cur_line
         #
         # So that's what we're going to do...
-        util.logger.info('({}) {}'.format(self.username, self._cur_line))
-        self.lines.append(self._cur_line)
-        self.callback(self._create_message())
+        line = self._cur_line
+        finished = op_code & self.END
+
+        # Only log the final line of each phase, not every percent
+        if finished:
+            util.logger.info('({}) {}'.format(self.username, line))
+
+            match = RECEIVED_REGEX.search(message or '')
+            if self.trace is not None and match and \
+                    op_code & self.OP_MASK == self.RECEIVING:
+                self.trace.add_bytes(
+                    int(float(match.group(1)) * UNITS[match.group(2)]))
+
+        with self._lock:
+            self._phase = PHASES.get(op_code & self.OP_MASK, self._phase)
+            self._percent = (int(100 * cur_count / max_count)
+                             if max_count else None)
+            if finished:
+                self._lines.append(line)
+                self._current = None
+            else:
+                self._current = line
+        self._request_flush()
+
+    def download(self, received, total=None):
+        """
+        Reports that received bytes (of total, if known) of a file download
+        have arrived.
+        """
+        line = 'Downloaded {} of {} bytes'.format(
+            received, total if total else 'unknown')
+
+        with self._lock:
+            self._phase = 'Downloading'
+            self._percent = int(100 * received / total) if total else None
+            self._current = line
+        self._request_flush()
+
+    def close(self):
+        """Drops the progress that wasn't sent yet and any that comes later."""
+        with self._lock:
+            self._closed = True
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _request_flush(self):
+        if self.io_loop is None:
+            self._flush()
+            return
+
+        with self._lock:
+            if self._flush_scheduled or self._closed:
+                return
+            self._flush_scheduled = True
+        # add_callback is the only IOLoop method safe to call from here
+        self.io_loop.add_callback(self._schedule_flush)
+
+    def _schedule_flush(self):
+        if self._closed:
+            return
+        self._timeout = self.io_loop.call_at(
+            max(self.io_loop.time(), self._last_flush + self.interval),
+            self._flush)
+
+    def _flush(self):
+        self._timeout = None
+        with self._lock:
+            if self._closed:
+                return
+            payload = {
+                'lines': self._lines,
+                'current': self._current,
+                'phase': self._phase,
+                'percent': self._percent,
+            }
+            self._lines = []
+            self._flush_scheduled = False
+
+        if self.io_loop is not None:
+            self._last_flush = self.io_loop.time()
+        self.callback(messages.progress(payload))
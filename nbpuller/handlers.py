@@ -5,30 +5,48 @@
 - Progress : page containing live updates on server's progress, redirects to
              new content once pull or clone is complete
 """
+import functools
+import hmac
 import json
 import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, dirname
 from operator import xor
-from concurrent.futures import ThreadPoolExecutor
 from notebook.utils import url_path_join
 from notebook.base.handlers import IPythonHandler
 from nbpuller.config import config_for_env
 
 from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
 from tornado.options import define, options
-from tornado.web import RequestHandler
-from tornado.websocket import WebSocketHandler
+from tornado.web import HTTPError, RequestHandler
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 from webargs import fields
 from webargs.tornadoparser import use_args
 
+from . import jobs
+from . import maintenance
 from . import messages
+from . import metrics
+from . import prewarm
 from . import util
 from .download_file_and_redirect import download_file_and_redirect
 from .git_progress import Progress
-from .pull_from_remote import pull_from_remote
+from .pull_from_remote import current_redirect, pull_from_remote, \
+    repo_dir_for
 from .config import Config
+from .scheduler import Scheduler, ServerBusy
 
-thread_pool = ThreadPoolExecutor(max_workers=4)
+# Created by setup_handlers once the config is known
+scheduler = None
+# Runs the landing page's current_redirect checks, which may wait on the
+# remote. Tornado's default executor also resolves host names for downloads.
+redirect_executor = None
+# current_redirect checks submitted and not finished yet
+_pending_checks = 0
 
 url_args = {
     'file_url': fields.Str(),
@@ -38,9 +56,53 @@ url_args = {
     'branch': fields.Str(),
     'path': fields.List(fields.Str()),
     'notebook_path': fields.Str(),
+    'source': fields.List(fields.Str()),
 }
 
 
+def parse_sources(args):
+    """
+    Returns the list of requests in the args of an interact link, each a dict
+    with either file_url or repo and path, and defaults filled in for the
+    other git options.
+
+    A link is either a single request, or has a source parameter for each
+    request holding the url-encoded args of that request.
+
+    Returns None if any request is invalid.
+    """
+    if 'source' in args:
+        sources = [_parse_source(source) for source in args['source']]
+    else:
+        sources = [dict(args)]
+
+    for source in sources:
+        is_file_request = ('file_url' in source)
+        # branch name can be omitted for default value
+        is_git_request = ('repo' in source and 'path' in source)
+        if not xor(is_file_request, is_git_request):
+            return None
+
+        if is_git_request:
+            source.setdefault('branch', Config.DEFAULT_BRANCH_NAME)
+            source.setdefault('notebook_path', '')
+            source.setdefault('domain', Config.DEFAULT_DOMAIN)
+            source.setdefault('account', Config.DEFAULT_GITHUB_ACCOUNT)
+
+    return sources or None
+
+
+def _parse_source(source):
+    """Parses the url-encoded args of one request in a multi-source link."""
+    args = {}
+    for name, values in urllib.parse.parse_qs(source).items():
+        if name == 'path':
+            args[name] = values
+        elif name in url_args and name != 'source':
+            args[name] = values[-1]
+    return args
+
+
 class LandingHandler(IPythonHandler):
     """
     Landing page containing option to download.
@@ -64,13 +126,25 @@ class LandingHandler(IPythonHandler):
     Example: ?repo=textbook&path=notebooks&path=chapter1%2Fintroduction.md, when using default branch name
 
     Pulls content into user's file system.
+
+    Option 3
+    --------
+
+        ?source=url_encoded_option_1_or_2&source=another_one
+
+    Example: ?source=file_url%3Dhttp%3A%2F%2Flocalhost%3A8000%2Flab01.ipynb&source=repo%3Ddata%26path%3Dlab01
+
+    Runs every request at once and redirects to the first one's destination
+    when all of them are done.
+
+    A single pull whose checkout is already current is answered with a plain
+    redirect, without the progress page.
     """
+    @gen.coroutine
     @use_args(url_args)
     def get(self, args):
-        is_file_request = ('file_url' in args)
-        # branch name can be omitted for default value
-        is_git_request = ('repo' in args and 'path' in args)
-        valid_request = xor(is_file_request, is_git_request)
+        sources = parse_sources(args)
+        valid_request = sources is not None
 
         def server_extension_url(url):
             return 'nbextensions/nbpuller/' + url
@@ -78,11 +152,6 @@ class LandingHandler(IPythonHandler):
         if not valid_request:
             self.render('404.html', server_extension_url=server_extension_url,)
 
-        util.logger.info("rendering progress page")
-
-        # These config options are passed into the `openStatusSocket`
-        # JS function.
-
         username = str(self.get_current_user())
 
         try:
@@ -92,6 +161,19 @@ class LandingHandler(IPythonHandler):
 
         util.logger.info("Username: " + username)
 
+        if valid_request and len(sources) == 1 and 'repo' in sources[0] and \
+                _pending_checks < options.config['REDIRECT_CHECK_WORKERS']:
+            redirect_url = yield self._current_redirect(username, sources[0])
+            if redirect_url:
+                metrics.FAST_REDIRECTS.inc()
+                self.redirect(redirect_url)
+                return
+
+        util.logger.info("rendering progress page")
+
+        # These config options are passed into the `openStatusSocket`
+        # JS function.
+
         socket_args = json.dumps({
             'is_development': options.config['DEBUG'],
             'base_url': options.config['URL'],
@@ -104,6 +186,35 @@ class LandingHandler(IPythonHandler):
             server_extension_url=server_extension_url,
         )
 
+    @gen.coroutine
+    def _current_redirect(self, username, args):
+        """
+        Runs current_redirect for the pull in args on redirect_executor, since
+        it reads from disk and may ask the remote for its head. While all of
+        its threads are busy, LandingHandler renders the progress page without
+        checking.
+        """
+        global _pending_checks
+        _pending_checks += 1
+        try:
+            redirect_url = yield IOLoop.current().run_in_executor(
+                redirect_executor,
+                functools.partial(
+                    current_redirect,
+                    username=username,
+                    repo_name=args['repo'],
+                    branch_name=args['branch'],
+                    paths=args['path'],
+                    config=options.config,
+                    notebook_path=args['notebook_path'],
+                    account=args['account'],
+                    domain=args['domain'],
+                ),
+            )
+        finally:
+            _pending_checks -= 1
+        return redirect_url
+
 
 class RequestHandler(WebSocketHandler):
     """
@@ -117,59 +228,414 @@ class RequestHandler(WebSocketHandler):
     @use_args(url_args)
     def open(self, username, args):
         util.logger.info('({}) Websocket connected'.format(username))
+        metrics.ACTIVE_WEBSOCKETS.inc()
+        self._counted = True
+        # (job, listener) of each pull this socket listens to
+        self._jobs = []
 
         # We don't do validation since we assume that the LandingHandler did
         # it. TODO: ENHANCE SECURITY
+        sources = parse_sources(args)
+        if sources is None:
+            self._send(messages.error('Invalid interact link'))
+            return
+
+        if len(sources) == 1:
+            message = yield self._run(username, sources[0],
+                                      self._send)
+        else:
+            # Each request's progress is labelled with its name
+            results = yield gen.multi([
+                self._run(username, source,
+                          _labelled(_source_name(source), self._send))
+                for source in sources
+            ])
+            message = _combine(sources, results)
+
+        if message['type'] == "ERROR":
+            util.logger.exception('Sent message: {}'.format(message))
+        else:
+            util.logger.info('Sent message: {}'.format(message))
+        self._send(message)
+
+    @gen.coroutine
+    def _run(self, username, args, listener):
+        """
+        Runs the download or pull for args, sending its progress to listener.
+
+        Returns its final message.
+        """
         is_file_request = ('file_url' in args)
+        operation = 'download' if is_file_request else 'pull'
+        started = time.monotonic()
 
         try:
             if is_file_request:
-                message = yield thread_pool.submit(
-                    download_file_and_redirect,
-                    username=username,
-                    file_url=args['file_url'],
-                    config=options.config,
-                )
-            else:
-                if 'branch' not in args:
-                    args['branch'] = Config.DEFAULT_BRANCH_NAME
-                if 'notebook_path' not in args:
-                    args['notebook_path'] = ''
-                if 'domain' not in args:
-                    args['domain'] = Config.DEFAULT_DOMAIN
-                if 'account' not in args:
-                    args['account'] = Config.DEFAULT_GITHUB_ACCOUNT
-
-                message = yield thread_pool.submit(
-                    pull_from_remote,
-                    username=username,
-                    repo_name=args['repo'],
-                    domain=args['domain'],
-                    account=args['account'],
-                    branch_name=args['branch'],
-                    paths=args['path'],
-                    config=options.config,
-                    notebook_path=args['notebook_path'],
-                    progress=Progress(username, self.write_message)
+                progress = Progress(
+                    username,
+                    listener,
+                    io_loop=IOLoop.current(),
+                    max_rate=options.config['PROGRESS_MAX_RATE'],
                 )
-
-            if message['type'] == "ERROR":
-                util.logger.exception('Sent message: {}'.format(message))
+                try:
+                    message = yield download_file_and_redirect(
+                        username=username,
+                        file_url=args['file_url'],
+                        config=options.config,
+                        progress=progress,
+                    )
+                finally:
+                    progress.close()
             else:
-                util.logger.info('Sent message: {}'.format(message))
-            self.write_message(message)
+                message = yield self._wait_in_queue(
+                    self._join_pull(username, args, listener), listener)
+        except ServerBusy as e:
+            metrics.ERRORS.inc(operation, 'ServerBusy')
+            message = messages.error({
+                'message': str(e),
+                'proceed_url': options.config['ERROR_REDIRECT_URL'],
+                'retry_after': e.retry_after,
+            })
         except Exception as e:
+            metrics.ERRORS.inc(operation, type(e).__name__)
             # If something bad happens, the client should see it
+            util.logger.exception('({}) {} failed'.format(username,
+                                                          operation))
             message = messages.error(str(e))
-            util.logger.exception('Sent message: {}'.format(message))
+
+        metrics.PHASE_SECONDS.observe(
+            time.monotonic() - started, operation, 'total')
+        metrics.REQUESTS.inc(
+            operation, 'error' if message['type'] == 'ERROR' else 'ok')
+        return message
+
+    def _join_pull(self, username, args, listener):
+        """
+        Attaches listener to the pull for args, starting it if no identical
+        pull is already running for this user and repo.
+
+        Returns the future of the pull.
+        """
+        repo_dir = repo_dir_for(options.config, username, args['repo'],
+                                args['notebook_path'])
+        key = (username, repo_dir)
+        request = (args['domain'], args['account'], args['repo'],
+                   args['branch'], tuple(args['path']))
+
+        job = jobs.find(key, request)
+        if job is None:
+            job = jobs.Job(key, request)
+            progress = Progress(
+                username,
+                job.broadcast,
+                io_loop=IOLoop.current(),
+                max_rate=options.config['PROGRESS_MAX_RATE'],
+            )
+            job.future = scheduler.submit(
+                username,
+                repo_dir,
+                pull_from_remote,
+                username=username,
+                repo_name=args['repo'],
+                domain=args['domain'],
+                account=args['account'],
+                branch_name=args['branch'],
+                paths=args['path'],
+                config=options.config,
+                notebook_path=args['notebook_path'],
+                progress=progress,
+            )
+            io_loop = IOLoop.current()
+            # Progress flushes still pending would follow the final message
+            job.future.add_done_callback(
+                lambda _: io_loop.add_callback(progress.close))
+            jobs.register(job)
+        else:
+            util.logger.info('({}) Joining running pull into {}'
+                             .format(username, repo_dir))
+
+        self._jobs.append((job, listener))
+        job.add_listener(listener)
+        return job.future
+
+    @gen.coroutine
+    def _wait_in_queue(self, future, listener):
+        """
+        Waits for a scheduler future, telling listener its place in the queue
+        every QUEUE_STATUS_INTERVAL_S while it hasn't started.
+        """
+        last_position = [None]
+
+        def send_position():
+            position = scheduler.position(future)
+            if position is not None and position != last_position[0]:
+                last_position[0] = position
+                listener(messages.status(
+                    'Waiting for the server, {} requests ahead of you'
+                    .format(position)))
+
+        send_position()
+        callback = PeriodicCallback(
+            send_position, options.config['QUEUE_STATUS_INTERVAL_S'] * 1000)
+        callback.start()
+        try:
+            result = yield future
+        finally:
+            callback.stop()
+        return result
+
+    def _send(self, message):
+        """Writes message to the socket, unless the client went away."""
+        try:
             self.write_message(message)
+        except WebSocketClosedError:
+            util.logger.info('Dropped message for closed websocket: {}'
+                             .format(message['type']))
+
+    def on_close(self):
+        if getattr(self, '_counted', False):
+            metrics.ACTIVE_WEBSOCKETS.dec()
+            self._counted = False
+
+        for job, listener in getattr(self, '_jobs', []):
+            job.remove_listener(listener)
+
+
+def _source_name(args):
+    """Returns a short name for a request, used to label its progress."""
+    if 'file_url' in args:
+        return os.path.basename(urllib.parse.urlparse(args['file_url']).path)
+    return args['repo']
+
+
+def _labelled(name, listener):
+    """
+    Returns a listener that prefixes the text of status and progress messages
+    with [name] before passing them on to listener.
+    """
+    label = '[{}] '.format(name)
+
+    def labelled(message):
+        payload = message['payload']
+        if message['type'] == messages.TYPES['progress']:
+            payload = dict(
+                payload,
+                lines=[label + line for line in payload['lines']],
+                current=payload['current'] and label + payload['current'],
+                phase=payload['phase'] and label + payload['phase'],
+            )
+        elif isinstance(payload, str):
+            payload = label + payload
+        listener(dict(message, payload=payload))
+
+    return labelled
+
+
+def _combine(sources, results):
+    """
+    Combines the final messages of the requests of a multi-source link.
+
+    If all succeeded, redirects to where the first request would have, with
+    each request's payload under 'sources'. Otherwise returns the first error,
+    with the failed request's name in its message.
+    """
+    for source, result in zip(sources, results):
+        if result['type'] != 'ERROR':
+            continue
+        payload = result['payload']
+        if not isinstance(payload, dict):
+            payload = {'message': payload,
+                       'proceed_url': options.config['ERROR_REDIRECT_URL']}
+        return messages.error(dict(payload, message='{}: {}'.format(
+            _source_name(source), payload['message'])))
+
+    first = results[0]['payload']
+    url = first['url'] if isinstance(first, dict) else first
+    return messages.redirect({
+        'url': url,
+        'sources': [result['payload'] for result in results],
+    })
+
+
+def _check_token(request, token):
+    """
+    Raises a 403 unless request has "Authorization: Bearer <token>". An
+    empty token refuses every request.
+    """
+    supplied = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(
+            supplied.encode(), ('Bearer ' + token).encode()):
+        raise HTTPError(403)
+
+
+class MetricsHandler(IPythonHandler):
+    """
+    Serves the metrics from metrics.py in the Prometheus text format.
+    Requests need "Authorization: Bearer <METRICS_TOKEN>".
+    """
+    def get(self):
+        _check_token(self.request, options.config['METRICS_TOKEN'])
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.render())
+
+
+class PrewarmHandler(IPythonHandler):
+    """
+    Lets admins stage a repo before an assignment is released, see
+    prewarm.py. Requests need "Authorization: Bearer <PREWARM_TOKEN>" and a
+    JSON body like:
+
+        {"repo": "materials", "path": ["labs/lab01"],
+         "usernames": ["alice", "bob"]}
+
+    branch, domain, account and notebook_path are optional as for interact
+    links. prewarm.prepare runs first, then prewarm.pull_user for each user
+    as a task of that user. The response streams one JSON message per line:
+    status updates and git progress, then the final message from
+    prewarm.summary.
+    """
+    def check_xsrf_cookie(self):
+        # Authenticated by the token rather than the notebook's cookies
+        pass
+
+    @gen.coroutine
+    def post(self):
+        _check_token(self.request, options.config['PREWARM_TOKEN'])
+
+        try:
+            body = json.loads(self.request.body.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, 'The body must be JSON')
+        if not isinstance(body, dict) or 'repo' not in body or \
+                not body.get('path'):
+            raise HTTPError(400, 'repo and path are required')
+
+        self._closed = False
+        self.set_header('Content-Type', 'application/x-ndjson')
+        io_loop = IOLoop.current()
+        progress = Progress(
+            'prewarm',
+            self._send,
+            io_loop=io_loop,
+            max_rate=options.config['PROGRESS_MAX_RATE'],
+        )
+        kwargs = dict(
+            domain=body.get('domain', Config.DEFAULT_DOMAIN),
+            account=body.get('account', Config.DEFAULT_GITHUB_ACCOUNT),
+            repo_name=body['repo'],
+            branch_name=body.get('branch', Config.DEFAULT_BRANCH_NAME),
+            paths=body['path'],
+            config=options.config,
+            usernames=body.get('usernames', []),
+            notebook_path=body.get('notebook_path', ''),
+        )
+
+        try:
+            future = scheduler.submit(
+                'prewarm',
+                None,
+                prewarm.prepare,
+                report=lambda message: io_loop.add_callback(
+                    self._send, message),
+                progress=progress,
+                **kwargs
+            )
+        except ServerBusy as e:
+            self.set_header('Retry-After', str(e.retry_after))
+            raise HTTPError(503, str(e))
+
+        try:
+            message = yield future
+        finally:
+            progress.close()
+        if message['type'] != 'ERROR':
+            results = yield self._pull_users(kwargs)
+            message = prewarm.summary(kwargs['repo_name'],
+                                      message['payload']['mirror'], results)
+        self._send(message)
+        if not self._closed:
+            self.finish()
+
+    @gen.coroutine
+    def _pull_users(self, kwargs):
+        """
+        Runs prewarm.pull_user for each user as their own scheduler task,
+        waiting for earlier ones to finish while the queue is full.
+
+        Returns {username: result}.
+        """
+        usernames = kwargs['usernames']
+        futures = {}
+        for username in usernames:
+            while True:
+                try:
+                    futures[username] = scheduler.submit(
+                        username,
+                        repo_dir_for(options.config, username,
+                                     kwargs['repo_name'],
+                                     kwargs['notebook_path']),
+                        prewarm.pull_user,
+                        username,
+                        **kwargs
+                    )
+                    break
+                except ServerBusy as e:
+                    pending = [future for future in futures.values()
+                               if not future.done()]
+                    if pending:
+                        # The oldest is usually the first one to finish
+                        try:
+                            yield pending[0]
+                        except Exception:
+                            # Reported with the results below
+                            pass
+                    else:
+                        yield gen.sleep(e.retry_after)
+
+        results = {}
+        for i, username in enumerate(usernames):
+            try:
+                results[username] = yield futures[username]
+            except Exception as e:
+                util.logger.exception('Prewarm of {} failed'.format(username))
+                results[username] = str(e)
+            self._send(messages.status('Pulled for {} ({} of {})'.format(
+                username, i + 1, len(usernames))))
+        return results
+
+    @gen.coroutine
+    def _send(self, message):
+        if self._closed:
+            return
+        self.write(json.dumps(message) + '\n')
+        try:
+            yield self.flush()
+        except StreamClosedError:
+            self._closed = True
+
+    def on_connection_close(self):
+        # The prewarm keeps running, only its output is dropped
+        self._closed = True
 
 
 def setup_handlers(web_app):
+    global scheduler, redirect_executor
+
     env_name = 'production'
     config = config_for_env(env_name, web_app.settings['base_url'])
     define('config', config)
 
+    scheduler = Scheduler(
+        config['PULL_WORKERS'],
+        config['PULL_QUEUE_DEPTH'],
+        config['BUSY_RETRY_S'],
+    )
+    metrics.QUEUE_DEPTH.function = scheduler.queue_depth
+    maintenance.start(config, scheduler)
+    redirect_executor = ThreadPoolExecutor(
+        config['REDIRECT_CHECK_WORKERS'],
+        thread_name_prefix='nbpuller-redirect')
+
     settings = dict(
         debug=True,
         serve_traceback=True,
@@ -188,5 +654,7 @@ def setup_handlers(web_app):
     web_app.add_handlers(host_pattern, [
         (route_pattern, LandingHandler),
         (route_pattern + '/', LandingHandler),
+        (route_pattern + '/metrics', MetricsHandler),
+        (route_pattern + '/prewarm', PrewarmHandler),
         (socket_url, RequestHandler)
     ])
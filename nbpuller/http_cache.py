@@ -0,0 +1,102 @@
+"""
+Host-level cache of files downloaded with file_url.
+
+Each url is stored once under FILE_CACHE_PATH, named by the sha256 of the url:
+
+    <key>       the file itself
+    <key>.json  its ETag and Last-Modified headers, and when it was last
+                fetched or revalidated
+    <key>.lock  held while the entry is checked or updated
+
+Within FILE_CACHE_TTL_S of the last check an entry is used without asking the
+origin. After that it is revalidated with a conditional request, so an
+unchanged file is never downloaded twice.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+
+class CacheEntry(object):
+    """The cached copy of one url."""
+    def __init__(self, cache_dir, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        self.url = url
+        self.body_path = os.path.join(cache_dir, key)
+        self.meta_path = self.body_path + '.json'
+        self.lock_path = self.body_path + '.lock'
+        self.meta = None
+        self._lock_file = None
+
+    def acquire(self, blocking=True):
+        """
+        Takes an exclusive lock on the entry, so only one of many concurrent
+        requests for a url goes to the origin, then loads its metadata.
+
+        If blocking is False and the lock is held elsewhere, returns False
+        right away instead of waiting. Returns True once the lock is taken.
+        """
+        os.makedirs(os.path.dirname(self.body_path), exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        self.meta = self._load_meta()
+        return True
+
+    def release(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def is_fresh(self, ttl_s):
+        """Returns whether the entry can be used without revalidating it."""
+        return (self.meta is not None and
+                time.time() - self.meta['checked_at'] < ttl_s)
+
+    def validators(self):
+        """Returns the headers that make a request for url conditional."""
+        headers = {}
+        if self.meta is not None:
+            if self.meta.get('etag'):
+                headers['If-None-Match'] = self.meta['etag']
+            if self.meta.get('last_modified'):
+                headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+    def stored(self, headers):
+        """
+        Records that body_path was just written with a response that had
+        headers.
+        """
+        self.meta = {
+            'url': self.url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        self.revalidated()
+
+    def revalidated(self):
+        """Records that the origin just confirmed the entry is current."""
+        self.meta['checked_at'] = time.time()
+
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(tmp_path, self.meta_path)
+
+    def _load_meta(self):
+        if not os.path.exists(self.body_path):
+            return None
+        try:
+            with open(self.meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,111 @@
+"""
+Bookkeeping for pulls that are in flight.
+
+Two tabs (or a double click) asking for the same pull share a single Job and
+both get its progress and final message. Different pulls into the same repo
+directory are serialized by the lock from repo_lock, so git never runs twice
+at once on one .git directory.
+"""
+import os
+import threading
+
+from . import messages
+
+# Progress lines replayed to listeners that attach late, as many as the
+# progress page shows
+REPLAY_LINES = 10
+
+_lock = threading.Lock()
+_jobs = {}
+_repo_locks = {}
+
+
+class Job(object):
+    """
+    A pull running in the thread pool, keyed by (username, repo_dir).
+
+    Messages passed to broadcast are forwarded to every listener, which are
+    usually the write_message methods of the attached websockets.
+    """
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.future = None
+        self._listeners = []
+        # PROGRESS payload with the lines so far and the latest phase
+        self._progress = None
+        self._last_message = None
+        self._listeners_lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Attaches a listener. So that a late joiner doesn't start from an
+        empty log, it immediately gets the progress so far as one message,
+        then the latest message if that wasn't progress.
+        """
+        with self._listeners_lock:
+            self._listeners.append(listener)
+            replay = []
+            if self._progress is not None:
+                replay.append(messages.progress(dict(self._progress)))
+            if self._last_message is not None and \
+                    self._last_message['type'] != messages.TYPES['progress']:
+                replay.append(self._last_message)
+        for message in replay:
+            listener(message)
+
+    def remove_listener(self, listener):
+        with self._listeners_lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def broadcast(self, message):
+        with self._listeners_lock:
+            if message['type'] == messages.TYPES['progress']:
+                self._add_progress(message['payload'])
+            self._last_message = message
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(message)
+
+    def _add_progress(self, payload):
+        """Adds the new lines of a PROGRESS payload to self._progress."""
+        lines = self._progress['lines'] if self._progress else []
+        self._progress = dict(
+            payload, lines=(lines + payload['lines'])[-REPLAY_LINES:])
+
+
+def find(key, request):
+    """
+    Returns the in-flight job for key if it was started for the same request,
+    otherwise None.
+    """
+    with _lock:
+        job = _jobs.get(key)
+    if job is not None and job.request == request:
+        return job
+    return None
+
+
+def register(job):
+    """
+    Makes job visible to find until its future completes. job.future must
+    already be set.
+    """
+    with _lock:
+        _jobs[job.key] = job
+    job.future.add_done_callback(lambda _: _unregister(job))
+
+
+def _unregister(job):
+    with _lock:
+        # A newer job with a different request may have replaced this one
+        if _jobs.get(job.key) is job:
+            del _jobs[job.key]
+
+
+def repo_lock(repo_dir):
+    """Returns the lock that serializes git operations on repo_dir."""
+    with _lock:
+        return _repo_locks.setdefault(os.path.abspath(repo_dir),
+                                      threading.Lock())
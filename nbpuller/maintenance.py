@@ -0,0 +1,307 @@
+"""
+Background maintenance of the user repos nbpuller pulls into.
+
+Every pull adds objects (and sometimes a WIP commit) to the user's repo and
+nothing else ever cleans up after it, so .git directories keep growing and
+git status and merges get slower over a semester. With MAINTENANCE_INTERVAL_S
+set, each tick of start() maintains at most one repo on the pull scheduler,
+and only while no pull is waiting for it:
+
+    repack            packs loose objects into a single pack, leaving out
+                      objects borrowed from a GIT_CACHE_PATH mirror
+    prune             deletes unreachable objects older than
+                      MAINTENANCE_PRUNE_EXPIRE, packed or loose
+    commit_graph      writes the commit-graph, which speeds up merge-base
+                      and history walks
+    multi_pack_index  writes the multi-pack-index
+    sparse            drops sparse-checkout paths that no longer exist
+                      upstream nor on disk
+
+Repos are picked from the ones pulled since the server started, once they
+haven't been pulled for MAINTENANCE_IDLE_S, and at most once every
+MAINTENANCE_MIN_AGE_S (tracked with .git/nbpuller-maintained, so it survives
+restarts). A repo is skipped while a pull holds its lock, and a pull started
+during maintenance waits for it, so git never runs twice at once on a repo.
+"""
+import os
+import threading
+import time
+
+import git
+from tornado.ioloop import PeriodicCallback
+
+from . import git_backend
+from . import jobs
+from . import messages
+from . import metrics
+from . import sparse_checkout
+from . import tracing
+from . import util
+from .scheduler import ServerBusy
+
+# Scheduler user that maintenance tasks are queued for
+MAINTENANCE_USER = 'nbpuller-maintenance'
+
+# Touched in .git when a repo is maintained
+STAMP_NAME = 'nbpuller-maintained'
+
+_lock = threading.Lock()
+# repo_dir -> {'username', 'pulled', 'maintained'}, times from time.time().
+# 'maintained' is None until read from the stamp.
+_repos = {}
+
+
+def record(config, repo_dir, username):
+    """Registers a pull of username into repo_dir, if maintenance is on."""
+    if not config['MAINTENANCE_INTERVAL_S']:
+        return
+    with _lock:
+        entry = _repos.setdefault(repo_dir, {'maintained': None})
+        entry['username'] = username
+        entry['pulled'] = time.time()
+
+
+def start(config, scheduler):
+    """
+    Queues a run_due task on scheduler every MAINTENANCE_INTERVAL_S seconds,
+    unless the previous one is still running or pulls are waiting.
+
+    Returns the PeriodicCallback, or None if maintenance is disabled.
+    """
+    interval = config['MAINTENANCE_INTERVAL_S']
+    if not interval:
+        return None
+
+    running = [None]
+
+    def tick():
+        if running[0] is not None and not running[0].done():
+            return
+        if scheduler.queue_depth():
+            return
+        try:
+            running[0] = scheduler.submit(MAINTENANCE_USER, None, run_due,
+                                          config)
+        except ServerBusy:
+            return
+        running[0].add_done_callback(_log_failure)
+
+    callback = PeriodicCallback(tick, interval * 1000)
+    callback.start()
+    return callback
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        util.logger.error('Maintenance failed', exc_info=future.exception())
+
+
+def run_due(config):
+    """
+    Maintains the due repo that was maintained longest ago, skipping busy
+    ones.
+
+    Returns the final message of maintain, or None if no repo was due.
+    """
+    for repo_dir, username in _due_repos(config):
+        message = maintain(repo_dir, username, config)
+        if message is not None:
+            return message
+    return None
+
+
+def _due_repos(config):
+    """Yields (repo_dir, username) of the due repos, most overdue first."""
+    now = time.time()
+    with _lock:
+        entries = [(repo_dir, dict(entry))
+                   for repo_dir, entry in _repos.items()]
+
+    due = []
+    for repo_dir, entry in entries:
+        if now - entry['pulled'] < config['MAINTENANCE_IDLE_S']:
+            continue
+
+        maintained = entry['maintained']
+        if maintained is None:
+            try:
+                maintained = os.stat(os.path.join(
+                    repo_dir, '.git', STAMP_NAME)).st_mtime
+            except FileNotFoundError:
+                if not os.path.isdir(os.path.join(repo_dir, '.git')):
+                    # The user deleted the repo
+                    _forget(repo_dir)
+                    continue
+                maintained = 0
+            _set_maintained(repo_dir, maintained)
+
+        if now - maintained >= config['MAINTENANCE_MIN_AGE_S']:
+            due.append((maintained, repo_dir, entry['username']))
+
+    for _, repo_dir, username in sorted(due):
+        yield repo_dir, username
+
+
+def _set_maintained(repo_dir, maintained):
+    with _lock:
+        if repo_dir in _repos:
+            _repos[repo_dir]['maintained'] = maintained
+
+
+def _forget(repo_dir):
+    with _lock:
+        _repos.pop(repo_dir, None)
+
+
+def maintain(repo_dir, username, config):
+    """
+    Runs every maintenance step on repo_dir, then gives what they wrote in
+    .git back to username.
+
+    Returns None if a pull holds the repo's lock. Otherwise returns a status
+    message whose payload has the repo_dir, the reclaimed_bytes, the
+    sparse-checkout paths that were trimmed and the 'timing' summary from
+    tracing.py, or an error message.
+    """
+    lock = jobs.repo_lock(repo_dir)
+    if not lock.acquire(blocking=False):
+        util.logger.info('Not maintaining {}, a pull is running'.format(
+            repo_dir))
+        return None
+
+    try:
+        trace = tracing.Trace('maintenance')
+        with tracing.activate(trace):
+            message = _maintain(repo_dir, username, config)
+        message = trace.attach(message, config)
+    finally:
+        lock.release()
+
+    result = 'error' if message['type'] == 'ERROR' else 'ok'
+    metrics.MAINTENANCE_RUNS.inc(result)
+    if result == 'ok':
+        metrics.MAINTENANCE_RECLAIMED_BYTES.inc(
+            amount=max(message['payload']['reclaimed_bytes'], 0))
+    util.logger.info('Maintained {}: {}'.format(repo_dir, message['payload']))
+    return message
+
+
+def _maintain(repo_dir, username, config):
+    started_at = _touch_stamp(repo_dir)
+    _set_maintained(repo_dir, time.time())
+
+    repo = tracing.Repo(repo_dir)
+    backend = None
+    trimmed = []
+    try:
+        git_cli = repo.git
+        before = _count_objects(repo)
+        if before['count'] or before['packs'] > 1:
+            # Like git gc, unreachable packed objects become loose instead of
+            # being dropped, so prune's expiry applies to them too
+            with tracing.span('repack'):
+                git_cli.repack(
+                    '-A', '-d', '-l', '-q',
+                    '--unpack-unreachable=' +
+                    config['MAINTENANCE_PRUNE_EXPIRE'])
+            with tracing.span('prune'):
+                git_cli.prune(
+                    '--expire=' + config['MAINTENANCE_PRUNE_EXPIRE'])
+        with tracing.span('commit_graph'):
+            git_cli.commit_graph('write', '--reachable')
+        with tracing.span('multi_pack_index'):
+            git_cli.multi_pack_index('write')
+
+        with tracing.span('sparse'):
+            backend = git_backend.open_backend(config, repo)
+            trimmed = _trim_sparse_checkout(repo, backend)
+
+        after = _count_objects(repo)
+        return messages.status({
+            'message': 'Maintained ' + repo_dir,
+            'repo_dir': repo_dir,
+            'reclaimed_bytes': _size(before) - _size(after),
+            'trimmed': trimmed,
+        })
+
+    except git.exc.GitCommandError as git_err:
+        return messages.error({
+            'message': git_err.stderr,
+            'repo_dir': repo_dir,
+        })
+
+    finally:
+        if backend is not None:
+            backend.close()
+        repo.close()
+
+        if not config['MOCK_AUTH']:
+            keep_shared = config['DEDUP_MODE'] == 'hardlink'
+            with tracing.span('chown'):
+                if trimmed:
+                    # read-tree may have checked files out anywhere
+                    util.chown_dir(repo_dir, username,
+                                   keep_shared=keep_shared)
+                else:
+                    util.chown_repo_changes(repo_dir, username, [],
+                                            started_at,
+                                            keep_shared=keep_shared)
+
+
+def _touch_stamp(repo_dir):
+    """
+    Touches .git/nbpuller-maintained and returns its new mtime, according to
+    the file system's clock.
+    """
+    stamp_path = os.path.join(repo_dir, '.git', STAMP_NAME)
+    with open(stamp_path, 'a'):
+        os.utime(stamp_path)
+    return os.stat(stamp_path).st_mtime
+
+
+def _count_objects(repo):
+    """Returns the counts of git count-objects -v as a dict of ints."""
+    counts = {}
+    for line in repo.git.count_objects('-v').splitlines():
+        name, _, value = line.partition(':')
+        # Repos borrowing objects also list their alternates
+        if value.strip().isdigit():
+            counts[name.strip()] = int(value)
+    return counts
+
+
+def _size(counts):
+    """Returns the bytes used by the objects in the counts of a repo."""
+    return 1024 * (counts['size'] + counts['size-pack'] +
+                   counts['size-garbage'])
+
+
+def _trim_sparse_checkout(repo, backend):
+    """
+    Removes the sparse-checkout paths that aren't in HEAD anymore (they were
+    deleted upstream) and don't exist in the working tree either. Patterns
+    are kept, as are all paths if every one of them would go.
+
+    Returns the removed paths.
+    """
+    sparse = sparse_checkout.SparseCheckout(repo)
+    candidates = [
+        path for path, is_directory in sorted(sparse.paths.items())
+        if not sparse_checkout.GLOB_CHARS & set(path)
+        # Cone mode always checks out root files
+        and not (sparse.cone and not is_directory and '/' not in path)
+    ]
+    found = backend.object_types('HEAD', candidates)
+    stale = [path for path in candidates if not found[path] and
+             not os.path.lexists(os.path.join(repo.working_tree_dir, path))]
+    if len(stale) == len(sparse.paths):
+        return []
+
+    for path in stale:
+        sparse.remove(path)
+    if stale:
+        sparse.save()
+        # Cone mode may have become possible, which checks out more files
+        repo.git.read_tree('-mu', 'HEAD')
+        util.logger.info('Trimmed from the sparse checkout: {}'.format(stale))
+    return stale
@@ -11,6 +11,7 @@ from toolz.functoolz import curry
 
 TYPES = {
   'log': 'LOG',
+  'progress': 'PROGRESS',
   'status': 'STATUS',
   'redirect': 'REDIRECT',
   'error': 'ERROR',
@@ -30,6 +31,7 @@ def _message(message_type, payload, error=False):
     return message
 
 log = _message(TYPES['log'])
+progress = _message(TYPES['progress'])
 status = _message(TYPES['status'])
 redirect = _message(TYPES['redirect'])
 error = _message(TYPES['error'])
@@ -0,0 +1,172 @@
+"""
+Counters, gauges and latency histograms for pulls and downloads, served in
+the Prometheus text format by the MetricsHandler at /interact/metrics.
+
+Metrics are kept in memory by the server process, so they start from zero
+when it restarts.
+"""
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+_registry = []
+
+
+class _Metric(object):
+    """A metric with one value per combination of label values."""
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError('{} takes labels {}'.format(
+                self.name, self.label_names))
+        return tuple(str(label) for label in labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                              for name, value in pairs) + '}'
+
+    def samples(self):
+        """Yields the lines of this metric's samples."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '{}{} {}'.format(self.name, self._format_labels(key), value)
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. If function is given, it is called for
+    the current value instead.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        _Metric.__init__(self, name, documentation)
+        self.function = function
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._values[()] = self._values.get((), 0) + amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+        else:
+            with self._lock:
+                value = self._values.get((), 0)
+        yield '{} {}'.format(self.name, value)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            # Buckets are cumulative, each one counts every value up to its
+            # bound
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count)
+                            in self._values.items())
+        for key, (counts, total, count) in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '{}_bucket{} {}'.format(
+                    self.name, self._format_labels(key, [('le', bound)]),
+                    bucket_count)
+            yield '{}_bucket{} {}'.format(
+                self.name, self._format_labels(key, [('le', '+Inf')]), count)
+            yield '{}_sum{} {}'.format(
+                self.name, self._format_labels(key), total)
+            yield '{}_count{} {}'.format(
+                self.name, self._format_labels(key), count)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+REQUESTS = Counter(
+    'nbpuller_requests_total',
+    'Finished pull and download requests by result (ok or error).',
+    ['operation', 'result'])
+ERRORS = Counter(
+    'nbpuller_errors_total',
+    'Failed pull and download requests by error type.',
+    ['operation', 'type'])
+PHASE_SECONDS = Histogram(
+    'nbpuller_phase_seconds',
+    'Time spent in each phase of pulls, downloads and maintenance.',
+    ['operation', 'phase'])
+FAST_REDIRECTS = Counter(
+    'nbpuller_fast_redirects_total',
+    'Interact links answered with a plain redirect since the checkout was '
+    'already current.')
+MAINTENANCE_RUNS = Counter(
+    'nbpuller_maintenance_runs_total',
+    'Finished maintenance of user repos by result (ok or error).',
+    ['result'])
+MAINTENANCE_RECLAIMED_BYTES = Counter(
+    'nbpuller_maintenance_reclaimed_bytes_total',
+    'Bytes of git objects freed by maintenance of user repos.')
+# The function is set once the scheduler exists
+QUEUE_DEPTH = Gauge(
+    'nbpuller_queue_depth',
+    'Pulls waiting for a worker thread.',
+    function=lambda: 0)
+ACTIVE_WEBSOCKETS = Gauge(
+    'nbpuller_active_websockets',
+    'Websockets currently connected.')
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,255 @@
+"""
+Stages a repo on the host before an assignment is released.
+
+When a lab is released, every student clicks its link at once and each pull
+clones from the remote. prewarm() does that work ahead of time. It refreshes
+the host-level mirror (GIT_CACHE_PATH) from the remote, then pulls the paths
+for each given username so their sparse checkout already exists. At release
+time, pulls only have to bring in what changed since then, from the mirror.
+
+Admins reach it through the PrewarmHandler at /interact/prewarm, which runs
+prepare() and then each user's pull_user() as separate tasks on the pull
+scheduler, so a large class doesn't hold a worker for the whole prewarm. It
+can also be run on the host directly, where prewarm() pulls one user after
+another:
+
+    nbpuller-prewarm --repo materials --path labs/lab01 \\
+        --notebook-path '/home/{username}' --users-file students.txt
+
+The command runs in its own process, so nothing keeps it from pulling into
+a repo while the notebook server pulls into the same one. Run it before the
+links are handed out, not while students are using them.
+"""
+import argparse
+import json
+import sys
+
+from . import git_backend
+from . import messages
+from . import metrics
+from . import remote_refs
+from . import repo_cache
+from . import tracing
+from . import util
+from .config import Config, config_for_env
+from .pull_from_remote import pull_from_remote, remote_url, repo_dir_for, \
+    RemoteNotAllowed
+
+
+def prewarm(**kwargs):
+    """
+    Refreshes the mirror of a repo and pulls paths for each of usernames.
+
+    Required kwargs:
+        domain (str): Domain to pull from
+        account (str): (Github) account to use
+        repo_name (str): The repo to pull from
+        branch_name (str): Name of the branch in the repo.
+        paths (list of str): The folders and file names to pull.
+        config (Config): The config for this environment.
+
+    Optional kwargs:
+        usernames (list of str): Users to pull paths for, none by default.
+        notebook_path (str): As for pull_from_remote.
+        report (callable): Called with a status message before each step.
+        progress (Progress): Gets git's progress while the mirror is fetched.
+
+    Returns:
+        The message from summary, or the error message from prepare.
+    """
+    message = prepare(**kwargs)
+    if message['type'] == 'ERROR':
+        return message
+
+    usernames = kwargs.get('usernames') or []
+    report = kwargs.get('report') or (lambda message: None)
+    results = {}
+    for i, username in enumerate(usernames):
+        report(messages.status('Pulling for {} ({} of {})'.format(
+            username, i + 1, len(usernames))))
+        results[username] = pull_user(username, **kwargs)
+    return summary(kwargs['repo_name'], message['payload']['mirror'],
+                   results)
+
+
+def prepare(**kwargs):
+    """
+    Checks the request and refreshes the mirror, with the kwargs of prewarm.
+    Every username has to pull into a repo directory of their own.
+
+    Returns a status message whose payload has the mirror path (None without
+    GIT_CACHE_PATH) and the 'timing' summary from tracing.py, or an error
+    message.
+    """
+    trace = tracing.Trace('prewarm')
+    with tracing.activate(trace):
+        message = _prepare(**kwargs)
+    return trace.attach(message, kwargs['config'])
+
+
+def _prepare(**kwargs):
+    domain = kwargs['domain']
+    account = kwargs['account']
+    repo_name = kwargs['repo_name']
+    branch_name = kwargs['branch_name']
+    paths = kwargs['paths']
+    config = kwargs['config']
+    usernames = kwargs.get('usernames') or []
+    notebook_path = kwargs.get('notebook_path', '')
+    report = kwargs.get('report') or (lambda message: None)
+    progress = kwargs.get('progress')
+
+    assert repo_name and branch_name and paths and config
+
+    util.logger.info('Starting prewarm of {} {} for {} users'.format(
+        repo_name, paths, len(usernames)))
+
+    try:
+        repo_url = remote_url(config, domain, account, repo_name)
+    except RemoteNotAllowed as e:
+        metrics.ERRORS.inc('prewarm', e.error_type)
+        return messages.error({'message': str(e)})
+
+    repo_dirs = {}
+    for username in usernames:
+        repo_dir = repo_dir_for(config, username, repo_name, notebook_path)
+        if repo_dir in repo_dirs and repo_dirs[repo_dir] != username:
+            metrics.ERRORS.inc('prewarm', 'SharedRepoDir')
+            return messages.error({
+                'message': '{} and {} would both pull into {}, give a '
+                           'notebook_path with {{username}}'.format(
+                               repo_dirs[repo_dir], username, repo_dir)
+            })
+        repo_dirs[repo_dir] = username
+
+    mirror = repo_cache.mirror_dir(config, domain, account, repo_name)
+    if mirror is None and not usernames:
+        return messages.error({
+            'message': 'Nothing to prewarm: GIT_CACHE_PATH is not set and '
+                       'no usernames were given.'
+        })
+
+    if mirror is not None:
+        report(messages.status('Fetching {} into {}'.format(repo_url, mirror)))
+        with tracing.span('mirror'):
+            repo_cache.refresh_mirror(repo_url, mirror, branch_name,
+                                      progress=progress)
+            missing_paths = _missing_paths(config, repo_url, mirror,
+                                           branch_name, paths)
+        if missing_paths:
+            metrics.ERRORS.inc('prewarm', 'PathNotFound')
+            return messages.error({
+                'message': 'These paths do not exist in {}: {}'.format(
+                    branch_name, ', '.join(missing_paths))
+            })
+
+    return messages.status({
+        'message': 'Prepared {}'.format(repo_name),
+        'mirror': mirror,
+    })
+
+
+def pull_user(username, **kwargs):
+    """
+    Pulls the paths of a prewarm (with its kwargs) for username.
+
+    Returns 'ok' or the error message of the pull.
+    """
+    message = pull_from_remote(
+        username=username,
+        repo_name=kwargs['repo_name'],
+        branch_name=kwargs['branch_name'],
+        paths=kwargs['paths'],
+        config=kwargs['config'],
+        progress=None,
+        notebook_path=kwargs.get('notebook_path', ''),
+        account=kwargs['account'],
+        domain=kwargs['domain'],
+    )
+    if message['type'] != 'ERROR':
+        return 'ok'
+    payload = message['payload']
+    return payload.get('message', payload) if isinstance(payload, dict) \
+        else payload
+
+
+def summary(repo_name, mirror, results):
+    """
+    Returns the final message of a prewarm, given the result of each user's
+    pull_user. Its payload has the mirror path and the results.
+    """
+    failed = sum(1 for result in results.values() if result != 'ok')
+    util.logger.info('Prewarmed {} for {} users, {} failed'.format(
+        repo_name, len(results), failed))
+    return messages.status({
+        'message': 'Prewarmed {} for {} users, {} failed'.format(
+            repo_name, len(results), failed),
+        'mirror': mirror,
+        'users': results,
+    })
+
+
+def _missing_paths(config, repo_url, mirror, branch_name, paths):
+    """
+    Returns the paths that don't exist in branch_name of the mirror. Also
+    records the branch as just seen on the remote (see remote_refs).
+    """
+    repo = tracing.Repo(mirror)
+    backend = git_backend.open_backend(config, repo)
+    try:
+        remote_refs.record(repo_url, branch_name, remote_refs.ref_sha(
+            repo, 'refs/heads/' + branch_name))
+
+        found = backend.object_types(branch_name, paths)
+        return [path for path in paths if not found[path]]
+    finally:
+        backend.close()
+        repo.close()
+
+
+def _read_usernames(args):
+    usernames = list(args.user)
+    if args.users_file:
+        with open(args.users_file) as users_file:
+            usernames += [line.strip() for line in users_file
+                          if line.strip()]
+    return usernames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Stages a repo on this host before an assignment is '
+                    'released.')
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--path', action='append', required=True,
+                        help='folder or file to pull, can be repeated')
+    parser.add_argument('--branch', default=Config.DEFAULT_BRANCH_NAME)
+    parser.add_argument('--domain', default=Config.DEFAULT_DOMAIN)
+    parser.add_argument('--account', default=Config.DEFAULT_GITHUB_ACCOUNT)
+    parser.add_argument('--user', action='append', default=[],
+                        help='user to pull for, can be repeated')
+    parser.add_argument('--users-file',
+                        help='file with one username per line')
+    parser.add_argument('--notebook-path', default='',
+                        help="directory the repo is pulled into, with "
+                             "{username} for the user's name; COPY_PATH by "
+                             "default")
+    args = parser.parse_args(argv)
+
+    message = prewarm(
+        domain=args.domain,
+        account=args.account,
+        repo_name=args.repo,
+        branch_name=args.branch,
+        paths=args.path,
+        config=config_for_env('production', '/'),
+        usernames=_read_usernames(args),
+        notebook_path=args.notebook_path,
+        report=lambda status: print(status['payload'], file=sys.stderr),
+    )
+    print(json.dumps(message, indent=2))
+    return 1 if message['type'] == 'ERROR' else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
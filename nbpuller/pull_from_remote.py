@@ -1,10 +1,21 @@
+import contextlib
+import fnmatch
 import os
-import re
+from collections import namedtuple
 
 import git
 
 from . import util
+from . import dedup
+from . import git_backend
+from . import jobs
+from . import maintenance
 from . import messages
+from . import metrics
+from . import remote_refs
+from . import repo_cache
+from . import sparse_checkout
+from . import tracing
 
 
 def _generate_repo_url(scheme, domain, account, repo_name, auth_token=''):
@@ -18,6 +29,43 @@ def _generate_repo_url(scheme, domain, account, repo_name, auth_token=''):
     return "%s://%s/%s%s" % (scheme, netloc, account, repo_name)
 
 
+class RemoteNotAllowed(Exception):
+    """
+    Raised by remote_url for a domain or github account that isn't
+    whitelisted. error_type is 'DomainNotAllowed' or 'AccountNotAllowed'.
+    """
+    def __init__(self, message, error_type):
+        Exception.__init__(self, message)
+        self.error_type = error_type
+
+
+def remote_url(config, domain, account, repo_name):
+    """
+    Returns the url of the remote repo, checking domain and account against
+    the whitelists in config.
+    """
+    if domain not in config['ALLOWED_WEB_DOMAINS']:
+        raise RemoteNotAllowed(
+            "Specified domain " + domain + " is not allowed.",
+            'DomainNotAllowed')
+    if domain == config['GITHUB_DOMAIN']:
+        if account not in config['ALLOWED_GITHUB_ACCOUNTS']:
+            raise RemoteNotAllowed(
+                "Specified github account " + account + " is not allowed.",
+                'AccountNotAllowed')
+        return _generate_repo_url(config['GIT_URL_SCHEME'], domain, account,
+                                  repo_name, config['GITHUB_API_TOKEN'])
+    return _generate_repo_url(config['GIT_URL_SCHEME'], domain, '', repo_name)
+
+
+def repo_dir_for(config, username, repo_name, notebook_path=''):
+    """Returns the directory that repo_name is pulled into for username."""
+    if not notebook_path:
+        notebook_path = config['COPY_PATH']
+    return util.construct_path(notebook_path, {'username': username},
+                               repo_name)
+
+
 def pull_from_remote(**kwargs):
     """
     Initializes git repo if needed, then pulls new content from remote repo using
@@ -62,10 +110,22 @@ def pull_from_remote(**kwargs):
         paths (list of str): The folders and file names to pull.
         config (Config): The config for this environment.
 
+    The final message has a 'timing' summary of the pull from tracing.py.
+
     Returns:
         A message object from messages.py
     """
+    trace = tracing.Trace('pull')
+    progress = kwargs['progress']
+    if progress is not None:
+        progress.trace = trace
+
+    with tracing.activate(trace):
+        message = _pull_from_remote(**kwargs)
+    return trace.attach(message, kwargs['config'])
 
+
+def _pull_from_remote(**kwargs):
     # Parse Arguments
     username = kwargs['username']
     repo_name = kwargs['repo_name']
@@ -83,6 +143,7 @@ def pull_from_remote(**kwargs):
         notebook_path = config['COPY_PATH']
 
     util.logger.info('Starting pull.')
+    util.logger.info('    Request: {}'.format(tracing.current().request_id))
     util.logger.info('    User: {}'.format(username))
     util.logger.info('    Domain: {}'.format(domain))
     util.logger.info('    Account: {}'.format(account))
@@ -91,237 +152,740 @@ def pull_from_remote(**kwargs):
     util.logger.info('    Paths: {}'.format(paths))
 
     # Retrieve file form the git repository
-    repo_dir = util.construct_path(notebook_path, locals(), repo_name)
-    repo_url = ''
-    # Generate repo url
-    if domain not in config['ALLOWED_WEB_DOMAINS']:
+    repo_dir = repo_dir_for(config, username, repo_name, notebook_path)
+    try:
+        repo_url = remote_url(config, domain, account, repo_name)
+    except RemoteNotAllowed as e:
+        metrics.ERRORS.inc('pull', e.error_type)
         return messages.error({
-            'message': "Specified domain " + domain + " is not allowed.",
+            'message': str(e),
             'proceed_url': config['ERROR_REDIRECT_URL']
         })
-    if domain == config['GITHUB_DOMAIN']:
-        if account not in config['ALLOWED_GITHUB_ACCOUNTS']:
-            return messages.error({
-                'message': "Specified github account " + account + " is not allowed.",
-                'proceed_url': config['ERROR_REDIRECT_URL']
-            })
-        repo_url += _generate_repo_url("https", domain,
-                                       account, repo_name, config['GITHUB_API_TOKEN'])
-    else:
-        repo_url += _generate_repo_url("https",
-                                       domain, '', repo_name)
 
+    mirror = repo_cache.mirror_dir(config, domain, account, repo_name)
+
+    # Another pull into the same directory (eg. from a second tab with
+    # different paths) has to finish first.
+    lock = jobs.repo_lock(repo_dir)
+    if not lock.acquire(blocking=False):
+        util.logger.info('Waiting for running pull into {}'.format(repo_dir))
+        with tracing.span('lock'):
+            lock.acquire()
+
+    repo = None
+    backend = None
+    # Untracked files left out of the WIP commit
+    skipped = []
+    # Working tree paths written by this pull, used to fix their ownership.
+    # None means the whole repo has to be chowned.
+    changed_paths = None
     try:
         if not os.path.exists(repo_dir):
-            _initialize_repo(
-                repo_url,
-                repo_dir,
-                branch_name,
-                config,
-                progress=progress,
-            )
-
-        repo = git.Repo(repo_dir)
-
-        for path in paths:
-            _raise_error_if_git_file_not_exists(repo, branch_name, path)
-
-        _add_sparse_checkout_paths(repo_dir, paths)
-
-        _reset_deleted_files(repo, branch_name)
-        _make_commit_if_dirty(repo, repo_dir)
+            with tracing.span('clone'):
+                _initialize_repo(
+                    repo_url,
+                    repo_dir,
+                    branch_name,
+                    paths,
+                    config,
+                    progress=progress,
+                    mirror=mirror,
+                )
+            repo = tracing.Repo(repo_dir)
+        else:
+            # A fresh clone is already up to date; otherwise this is the only
+            # fetch of the whole pull.
+            repo = tracing.Repo(repo_dir)
+            started_at = _touch_stamp(repo_dir)
+            head_before = remote_refs.ref_sha(repo, 'HEAD')
+            changed_paths = []
+
+            with tracing.span('fetch'):
+                _fetch_origin(repo, branch_name, repo_url, config,
+                              progress=progress, mirror=mirror)
+        backend = git_backend.open_backend(config, repo)
+
+        with tracing.span('check'):
+            found = backend.object_types('origin/' + branch_name, paths)
+        missing_paths = [path for path in paths if not found[path]]
+        if missing_paths:
+            metrics.ERRORS.inc('pull', 'PathNotFound')
+            return messages.error({
+                'message': 'These paths do not exist in {}: {}'.format(
+                    'origin/' + branch_name, ', '.join(missing_paths)),
+                'proceed_url': config['ERROR_REDIRECT_URL']
+            })
 
-        _pull_and_resolve_conflicts(repo, branch_name, progress=progress)
+        sparse = sparse_checkout.SparseCheckout(repo)
+        new_paths = _add_sparse_checkout_paths(sparse, paths, found)
+
+        with tracing.span('reset'):
+            status = _status_snapshot(repo)
+            reset_files = _reset_deleted_files(repo, backend, branch_name,
+                                               status)
+        with tracing.span('commit'):
+            head = remote_refs.ref_sha(repo, 'HEAD')
+            upstream = remote_refs.ref_sha(
+                repo, 'refs/remotes/origin/' + branch_name)
+            strategy, local_paths = _choose_strategy(
+                backend, head, upstream, status, new_paths)
+            if strategy == WIP_MERGE:
+                incoming = new_paths
+                if status.untracked:
+                    incoming = incoming + _upstream_changes(
+                        backend, head, upstream)
+                skipped = _make_commit_if_dirty(repo, status, sparse, config,
+                                                incoming)
+            sparse.save()
+
+        _pull_and_resolve_conflicts(repo, branch_name, sparse, strategy,
+                                    local_paths)
+
+        if changed_paths is not None:
+            changed_paths += new_paths + reset_files + backend.changed_paths(
+                head_before, remote_refs.ref_sha(repo, 'HEAD'))
+            if sparse.changed and sparse.cone:
+                # Cone mode also checked out the files next to the new paths
+                changed_paths += _files_in(repo_dir, sparse.cone_parents())
+
+        if config['DEDUP_MODE']:
+            with tracing.span('dedup'):
+                dedup.dedup_checkout(repo, branch_name, paths, changed_paths,
+                                     config)
+
+        maintenance.record(config, repo_dir, username)
 
         if not config['GIT_REDIRECT_PATH']:
             return messages.status('Pulled from repo: ' + repo_name)
 
-        # Redirect to the final path given in the URL
-        destination = os.path.join(notebook_path, repo_name, paths[-1].replace('*', ''))
-        redirect_url = util.construct_path(config['GIT_REDIRECT_PATH'], {
-            'username': username,
-            'destination': destination,
-        })
+        redirect_url = _redirect_url(config, username, notebook_path,
+                                     repo_name, paths)
         util.logger.info('Redirecting to {}'.format(redirect_url))
-        return messages.redirect(redirect_url)
+        return messages.redirect({'url': redirect_url, 'skipped': skipped})
 
     except git.exc.GitCommandError as git_err:
+        metrics.ERRORS.inc('pull', 'GitCommandError')
+        # We can't tell what a failed command left behind
+        changed_paths = None
         return messages.error({
             'message': git_err.stderr,
             'proceed_url': config['ERROR_REDIRECT_URL']
         })
 
     finally:
-        # Always set ownership to username in case of a git failure
-        # In development, don't run the chown since the sample user doesn't
-        # exist on the system.
-        if config['MOCK_AUTH']:
-            util.logger.info("We're in development so we won't chown the dir.")
-        else:
-            util.chown_dir(repo_dir, username)
+        try:
+            if backend is not None:
+                backend.close()
+            # Stops the cat-file session started by the cli backend
+            if repo is not None:
+                repo.close()
+
+            # Files shared by dedup stay read-only for everyone
+            keep_shared = config['DEDUP_MODE'] == 'hardlink'
+
+            # Always set ownership to username in case of a git failure
+            # In development, don't run the chown since the sample user
+            # doesn't exist on the system.
+            if config['MOCK_AUTH']:
+                util.logger.info(
+                    "We're in development so we won't chown the dir.")
+            elif changed_paths is None:
+                with tracing.span('chown'):
+                    util.chown_dir(repo_dir, username,
+                                   keep_shared=keep_shared)
+            else:
+                with tracing.span('chown'):
+                    util.chown_repo_changes(
+                        repo_dir, username, changed_paths, started_at,
+                        keep_shared=keep_shared)
+        finally:
+            lock.release()
+
+
+def _redirect_url(config, username, notebook_path, repo_name, paths):
+    """Returns the url of the final path given in the URL."""
+    destination = os.path.join(notebook_path, repo_name, paths[-1].replace('*', ''))
+    return util.construct_path(config['GIT_REDIRECT_PATH'], {
+        'username': username,
+        'destination': destination,
+    })
+
+
+def current_redirect(**kwargs):
+    """
+    Returns the redirect url of a pull if the pull would change nothing,
+    otherwise None. Takes the same kwargs as pull_from_remote, except
+    progress.
+
+    That is the case when HEAD already contains the commit the remote branch
+    is at (see remote_refs), every path is in the sparse checkout and exists,
+    and no checked out file was deleted. Local edits don't matter since a pull
+    keeps them anyway. Any doubt, including a pull into the same directory
+    running right now, answers None, so the caller falls back to the full
+    pull.
+
+    This only reads files, plus at most a git ls-remote, a git merge-base
+    and a git ls-files. It doesn't take the repo lock or write anything.
+    """
+    username = kwargs['username']
+    repo_name = kwargs['repo_name']
+    branch_name = kwargs['branch_name']
+    paths = kwargs['paths']
+    config = kwargs['config']
+    account = kwargs['account']
+    domain = kwargs['domain']
+    notebook_path = kwargs['notebook_path'] or config['COPY_PATH']
+
+    if not config['GIT_REDIRECT_PATH'] or not config['REMOTE_FRESHNESS_TTL_S']:
+        return None
+
+    repo_dir = repo_dir_for(config, username, repo_name, notebook_path)
+    if not os.path.isdir(os.path.join(repo_dir, '.git')) or \
+            jobs.repo_lock(repo_dir).locked():
+        return None
+
+    repo = None
+    backend = None
+    try:
+        repo_url = remote_url(config, domain, account, repo_name)
+        repo = tracing.Repo(repo_dir)
+
+        sparse = sparse_checkout.SparseCheckout(repo)
+        if not all(sparse.covers(path) for path in paths):
+            return None
+        # Not there if it was deleted locally or doesn't exist upstream, and
+        # only a pull can say which
+        targets = [path for path in paths
+                   if not sparse_checkout.GLOB_CHARS & set(path)]
+        targets.append(paths[-1].replace('*', ''))
+        if not all(os.path.exists(os.path.join(repo_dir, path))
+                   for path in targets):
+            return None
+
+        head = remote_refs.ref_sha(repo, 'HEAD')
+        remote_sha = remote_refs.remote_head(
+            repo_url, branch_name, config['REMOTE_FRESHNESS_TTL_S'],
+            config['REMOTE_CHECK_TIMEOUT_S'])
+        if not head or not remote_sha:
+            return None
+        backend = git_backend.open_backend(config, repo)
+        if not backend.contains(head, remote_sha):
+            return None
+
+        # Skipped files outside the sparse checkout aren't listed
+        if repo.git.ls_files('--deleted', '-z'):
+            return None
+    except (RemoteNotAllowed, git.exc.GitError, OSError, ValueError):
+        util.logger.exception('Checking if {} is current failed'.format(
+            repo_dir))
+        return None
+    finally:
+        if backend is not None:
+            backend.close()
+        if repo is not None:
+            repo.close()
+
+    util.logger.info('({}) {} is current'.format(username, repo_dir))
+    return _redirect_url(config, username, notebook_path, repo_name, paths)
+
+
+def _touch_stamp(repo_dir):
+    """
+    Touches .git/nbpuller-stamp and returns its new mtime. This is the time
+    according to the file system's clock, which on NFS is the server's.
+    """
+    stamp_path = os.path.join(repo_dir, '.git', 'nbpuller-stamp')
+    with open(stamp_path, 'a'):
+        os.utime(stamp_path)
+    return os.stat(stamp_path).st_mtime
+
 
+# Extra git clone options for each GIT_CLONE_MODE. Partial clones only
+# download the blobs that the sparse checkout actually materializes.
+CLONE_MODE_OPTIONS = {
+    'full': {},
+    'blobless': {'filter': 'blob:none'},
+    'shallow': {'filter': 'blob:none', 'depth': 1},
+}
 
-def _initialize_repo(repo_url, repo_dir, branch_name, config, progress=None):
+
+def _initialize_repo(repo_url, repo_dir, branch_name, paths, config,
+                     progress=None, mirror=None):
     """
-    Clones repository and configures it to use sparse checkout.
-    Extraneous folders will get removed later using git read-tree
+    Clones repository without checking it out, configures it to use sparse
+    checkout for paths, then checks out only those paths. Nothing outside of
+    paths is ever written to the working tree.
+
+    If mirror is given, the clone is made from the host-level mirror and
+    borrows its objects instead of downloading them again. GIT_CLONE_MODE
+    only applies to clones from the remote, since the mirror is already local.
     """
+    clone_mode = config['GIT_CLONE_MODE']
+    if clone_mode not in CLONE_MODE_OPTIONS:
+        raise ValueError('Unknown GIT_CLONE_MODE: {}'.format(clone_mode))
+
     util.logger.info('Repo {} doesn\'t exist. Cloning...'.format(repo_url))
     # Clone repo
-    repo = git.Repo.clone_from(
-        repo_url,
-        repo_dir,
-        progress,
-        branch=branch_name,
-    )
+    if mirror:
+        remote_sha = remote_refs.remote_head(
+            repo_url, branch_name, config['REMOTE_FRESHNESS_TTL_S'],
+            config['REMOTE_CHECK_TIMEOUT_S'])
+        _refresh_mirror(repo_url, mirror, branch_name, remote_sha,
+                        progress=progress)
+        repo = repo_cache.clone_from_mirror(
+            mirror, repo_url, repo_dir, branch_name, no_checkout=True)
+    else:
+        repo = tracing.Repo.clone_from(
+            repo_url,
+            repo_dir,
+            progress,
+            branch=branch_name,
+            no_checkout=True,
+            **CLONE_MODE_OPTIONS[clone_mode]
+        )
+
+    remote_refs.record(repo_url, branch_name, remote_refs.ref_sha(
+        repo, 'refs/remotes/origin/' + branch_name))
 
     # Use sparse checkout
-    config = repo.config_writer()
-    config.set_value('core', 'sparsecheckout', True)
-    config.release()
+    repo_config = repo.config_writer()
+    repo_config.set_value('core', 'sparsecheckout', True)
+    repo_config.release()
+
+    backend = git_backend.open_backend(config, repo)
+    try:
+        found = backend.object_types('origin/' + branch_name, paths)
+    finally:
+        backend.close()
+    sparse = sparse_checkout.SparseCheckout(repo)
+    _add_sparse_checkout_paths(sparse, paths, found)
+    sparse.save()
+    repo.git.checkout(branch_name)
 
     util.logger.info('Repo {} initialized'.format(repo_url))
 
 
-DELETED_FILE_REGEX = re.compile(
-    r"deleted:\s+"  # Look for deleted: + any amount of whitespace...
-    r"([^\n\r]+)"        # and match the filename afterward.
-)
+# Read git status output in chunks of this many bytes
+STATUS_CHUNK_BYTES = 64 * 1024
+
+StatusSnapshot = namedtuple(
+    'StatusSnapshot', ['deleted', 'added', 'modified', 'untracked', 'staged'])
+StatusSnapshot.__doc__ = """
+Sets of paths, relative to the repo root, that differ from HEAD:
+
+    deleted: deleted from the working tree but not from the index
+    added: new in the index
+    modified: any other change to a tracked file
+    untracked: not in the index and not ignored
+    staged: changed in the index, including added and unmerged paths
+"""
+
+
+def _status_snapshot(repo):
+    """
+    Runs git status once and returns a StatusSnapshot of the repo.
+
+    The NUL-delimited porcelain v2 format is read as a stream, so filenames
+    are never quoted and the whole output is never held in memory.
+    """
+    snapshot = StatusSnapshot(set(), set(), set(), set(), set())
+
+    status = repo.git.status('--porcelain=v2', '-z', '--no-renames',
+                             '--untracked-files=all', as_process=True)
+    for entry in _read_entries(status.proc.stdout):
+        kind, _, rest = entry.partition(' ')
+        if kind == '?':
+            snapshot.untracked.add(rest)
+            continue
+        if kind not in ('1', 'u'):
+            continue
+
+        # 1 XY sub mH mI mW hH hI path, u has one more mode and hash
+        fields = rest.split(' ', 7 if kind == '1' else 9)
+        index_status, worktree_status = fields[0]
+        path = fields[-1]
+        if kind == 'u' or index_status != '.':
+            snapshot.staged.add(path)
+
+        if worktree_status == 'D':
+            snapshot.deleted.add(path)
+        elif index_status == 'A':
+            snapshot.added.add(path)
+        else:
+            snapshot.modified.add(path)
+    status.wait()
+
+    return snapshot
 
-ADDED_FILE_REGEX = re.compile(
-    r"new file:\s+"  # Look for deleted: + any amount of whitespace...
-    r"([^\n\r]+)"    # and match the filename afterward.
-)
 
+def _read_entries(stream):
+    """Yields the NUL-terminated entries of stream as strings."""
+    pending = b''
+    for chunk in iter(lambda: stream.read(STATUS_CHUNK_BYTES), b''):
+        entries = (pending + chunk).split(b'\0')
+        pending = entries.pop()
+        for entry in entries:
+            yield entry.decode('utf-8', 'surrogateescape')
+    if pending:
+        yield pending.decode('utf-8', 'surrogateescape')
 
-def _reset_deleted_files(repo, branch_name):
+
+def _reset_deleted_files(repo, backend, branch_name, status):
     """
     Runs the equivalent of git checkout -- <file> for each file that was
     deleted. This allows us to delete a file, hit an interact link, then get a
     clean version of the file again.
+
+    Files that no longer exist upstream are left deleted. status is the
+    StatusSnapshot of the repo and is updated to match.
+
+    Returns the files that were reset.
     """
-    git_cli = repo.git
-    deleted_files = DELETED_FILE_REGEX.findall(git_cli.status())
+    if not status.deleted:
+        return []
 
-    if deleted_files:
-        cleaned_filenames = []
+    deleted_files = sorted(status.deleted)
+    found = backend.object_types('origin/' + branch_name, deleted_files)
+    reset_files = [filename for filename in deleted_files if found[filename]]
 
-        for filename in deleted_files:
-            try:
-                _raise_error_if_git_file_not_exists(repo, branch_name, filename)
-                cleaned_filenames.append(_clean_path(filename))
-            except git.exc.GitCommandError as git_err:
-                pass
+    if reset_files:
+        # The paths are passed as separate arguments, so they must not be
+        # escaped like in the sparse-checkout file
+        repo.git.checkout('--', *reset_files)
+        status.deleted.difference_update(reset_files)
+    util.logger.info('Resetted these files: {}'.format(reset_files))
 
-        git_cli.checkout('--', *cleaned_filenames)
-        util.logger.info('Resetted these files: {}'.format(deleted_files))
+    return reset_files
 
 
-def _clean_path(path):
+def _files_in(repo_dir, directories):
     """
-    Clean filename so that it is command line friendly.
-
-    Currently just escapes spaces.
+    Returns the files directly inside each of directories (relative to
+    repo_dir), as paths relative to repo_dir.
     """
-    return path.replace(' ', '\ ')
+    files = []
+    for directory in directories:
+        try:
+            entries = os.scandir(os.path.join(repo_dir, directory))
+        except FileNotFoundError:
+            continue
+        with entries:
+            files += [os.path.join(directory, entry.name) for entry in entries
+                      if not entry.is_dir(follow_symlinks=False)]
+    return files
+
+
+def _add_sparse_checkout_paths(sparse, paths, found):
+    """
+    Adds each path in paths to the SparseCheckout sparse, as a directory if
+    found (from object_types of a git_backend) says it is one.
 
+    Always makes sure .gitignore is checked out
 
-def _raise_error_if_git_file_not_exists(repo, branch_name, filename):
+    Returns the paths that were added.
     """
-    Checks to see if the file or directory actually exists in the remote repo
-    using: git cat-file -e origin/<branch_name>:<filename>
-    """
-    git_cli = repo.git
+    util.logger.info(
+        'Existing paths in sparse-checkout: {}'.format(sorted(sparse.paths)))
+
+    added = [path for path in ['.gitignore'] + paths
+             if sparse.add(path, found.get(path) == 'tree')]
+
+    util.logger.info('{} added to sparse-checkout'.format(added))
+    return added
 
-    # fetch origin first so that cat-file can see if the file exists
-    try:
-        git_cli.fetch()
-    except git.exc.GitCommandError as git_err:
-        pass
 
-    result = git_cli.cat_file('-e', 'origin/' + branch_name + ':' + filename)
+# Name of the file in .git listing the paths given to a git command
+PATHSPEC_FILE = 'nbpuller-paths'
 
 
-def _add_sparse_checkout_paths(repo_dir, paths):
+@contextlib.contextmanager
+def _pathspec_file(repo, paths):
     """
-    Runs the equivalent of
+    Writes paths to a file in .git and yields the arguments that have a git
+    command read them from it, deleting the file afterwards.
 
-    echo /path >> .git/info/sparse-checkout
+    There may be too many paths for the command line, and they are written
+    as literal pathspecs so that names with * or other pathspec magic aren't
+    expanded.
+    """
+    pathspec_path = os.path.join(repo.git_dir, PATHSPEC_FILE)
+    with open(pathspec_path, 'wb') as pathspec_file:
+        for path in paths:
+            pathspec_file.write(':(literal){}\0'.format(path).encode(
+                'utf-8', 'surrogateescape'))
+    try:
+        yield ['--pathspec-from-file=' + pathspec_path, '--pathspec-file-nul']
+    finally:
+        os.unlink(pathspec_path)
 
-    for each path in paths but also avoids duplicates.
 
-    Always makes sure .gitignore is checked out
+def _make_commit_if_dirty(repo, status, sparse, config, incoming=()):
     """
-    sparse_checkout_path = os.path.join(repo_dir,
-                                        '.git', 'info', 'sparse-checkout')
+    Makes a commit with message 'WIP' if there are changes, according to the
+    StatusSnapshot status. Every change to tracked files goes in, untracked
+    files only if _select_untracked lets them or if they are in incoming, the
+    paths the merge is going to write, which would overwrite them. New files
+    are added to the SparseCheckout sparse so that they stay checked out.
+
+    Returns the untracked files that were left out, as dicts with their
+    path, size in bytes and the reason ('size', 'excluded' or 'budget').
+    """
+    untracked, skipped = _select_untracked(
+        repo.working_tree_dir, status.untracked, config)
+    in_the_way = [entry for entry in skipped
+                  if _overlaps([entry['path']], incoming)]
+    if in_the_way:
+        util.logger.warning('Committing anyway, upstream changes them: {}'
+                            .format(', '.join(entry['path']
+                                              for entry in in_the_way)))
+        untracked += [entry['path'] for entry in in_the_way]
+        skipped = [entry for entry in skipped if entry not in in_the_way]
+    if skipped:
+        util.logger.warning('Left out of the WIP commit: {}'.format(
+            ', '.join(entry['path'] for entry in skipped)))
+
+    if not (status.deleted or status.added or status.modified or untracked):
+        return skipped
 
-    existing_paths = []
-    try:
-        sparse_checkout_file = open(sparse_checkout_path, 'r')
-        with sparse_checkout_file as info_file:
-            existing_paths = [line.strip().strip('/')
-                              for line in info_file.readlines()]
-    except FileNotFoundError:
-        # If .git/info/sparse-checkout does not exist, create the file
-        open(sparse_checkout_path, 'w')
+    git_cli = repo.git
+    git_cli.add('-u')
+    if untracked:
+        with _pathspec_file(repo, untracked) as pathspec_args:
+            git_cli.add(*pathspec_args)
 
-    util.logger.info(
-        'Existing paths in sparse-checkout: {}'.format(existing_paths))
+    added_files = sorted(status.added | set(untracked))
+
+    if added_files:
+        for path in added_files:
+            sparse.add(path)
 
-    paths_with_gitignore = ['.gitignore'] + paths
-    to_write = [path for path in paths_with_gitignore
-                if path not in existing_paths]
+        util.logger.info('Added these files: {}'.format(added_files))
 
-    with open(sparse_checkout_path, 'a') as info_file:
-        for path in to_write:
-            info_file.write('/{}\n'.format(_clean_path(path)))
+    git_cli.commit('-m', 'WIP')
 
-    util.logger.info('{} written to sparse-checkout'.format(to_write))
+    util.logger.info('Made WIP commit')
+    return skipped
 
 
-def _make_commit_if_dirty(repo, repo_dir):
+def _select_untracked(repo_dir, paths, config):
     """
-    Makes a commit with message 'WIP' if there are changes.
+    Applies the WIP_EXCLUDE, WIP_MAX_FILE_BYTES and WIP_BYTE_BUDGET policy to
+    the untracked files paths. The budget is spent on the smallest files
+    first, so one huge file doesn't keep out many small ones.
+
+    Returns the paths to commit and the skipped files, as described in
+    _make_commit_if_dirty.
     """
-    if repo.is_dirty():
-        git_cli = repo.git
-        git_cli.add('-A')
+    max_bytes = config['WIP_MAX_FILE_BYTES']
+    budget = config['WIP_BYTE_BUDGET']
+
+    selected = []
+    skipped = []
+    candidates = []
+    for path in paths:
+        try:
+            size = os.lstat(os.path.join(repo_dir, path)).st_size
+        except FileNotFoundError:
+            continue
+
+        if any(fnmatch.fnmatch(path, pattern)
+               for pattern in config['WIP_EXCLUDE']):
+            skipped.append({'path': path, 'bytes': size, 'reason': 'excluded'})
+        elif max_bytes and size > max_bytes:
+            skipped.append({'path': path, 'bytes': size, 'reason': 'size'})
+        else:
+            candidates.append((size, path))
 
-        added_files = ADDED_FILE_REGEX.findall(git_cli.status())
+    spent = 0
+    for size, path in sorted(candidates):
+        if budget and spent + size > budget:
+            skipped.append({'path': path, 'bytes': size, 'reason': 'budget'})
+            continue
+        spent += size
+        selected.append(path)
 
-        if added_files:
-            sparse_checkout_path = os.path.join(repo_dir,
-                                        '.git', 'info', 'sparse-checkout')
+    return selected, sorted(skipped, key=lambda entry: entry['path'])
 
-            try:
-                open(sparse_checkout_path, 'r')
-            except FileNotFoundError:
-                open(sparse_checkout_path, 'w')
 
-            with open(sparse_checkout_path, 'a') as info_file:
-                for path in added_files:
-                    info_file.write('/{}\n'.format(_clean_path(path)))
+def _fetch_origin(repo, branch_name, repo_url, config, progress=None,
+                  mirror=None):
+    """
+    Fetches origin. With a mirror, the mirror is refreshed from the remote and
+    the user clone is updated from it locally.
 
-            util.logger.info('Added these files: {}'.format(added_files))
+    Nothing is fetched if origin/<branch_name> is already at the commit the
+    remote was last seen at (see remote_refs).
+    """
+    remote_sha = remote_refs.remote_head(
+        repo_url, branch_name, config['REMOTE_FRESHNESS_TTL_S'],
+        config['REMOTE_CHECK_TIMEOUT_S'])
+    origin_ref = 'refs/remotes/origin/' + branch_name
+    if remote_sha and remote_refs.ref_sha(repo, origin_ref) == remote_sha:
+        util.logger.info('origin/{} is up to date'.format(branch_name))
+        return
+
+    if not mirror:
+        repo.remote(name='origin').fetch(progress=progress)
+    else:
+        _refresh_mirror(repo_url, mirror, branch_name, remote_sha,
+                        progress=progress)
+        repo_cache.fetch_from_mirror(repo, mirror, branch_name)
+    remote_refs.record(repo_url, branch_name,
+                       remote_refs.ref_sha(repo, origin_ref))
 
-        git_cli.commit('-m', 'WIP')
 
-        util.logger.info('Made WIP commit')
+def _refresh_mirror(repo_url, mirror, branch_name, remote_sha, progress=None):
+    """
+    Refreshes the mirror from the remote, unless it already has branch_name
+    at remote_sha.
+    """
+    if remote_sha and os.path.exists(mirror) and remote_refs.ref_sha(
+            tracing.Repo(mirror), 'refs/heads/' + branch_name) == remote_sha:
+        util.logger.info('Mirror {} is up to date'.format(mirror))
+        return
+
+    repo_cache.refresh_mirror(repo_url, mirror, branch_name, progress=progress)
+
+
+# How _pull_and_resolve_conflicts brings in origin/<branch>:
+#
+#     UP_TO_DATE: HEAD already contains it, nothing to merge
+#     MERGE: merge it, leaving local changes uncommitted since it doesn't
+#         touch them
+#     WIP_MERGE: commit local changes as WIP first, then merge
+#     RESET: HEAD has commits of its own (eg. an earlier WIP merge), but
+#         neither they nor the local changes touch what changed upstream.
+#         Their changes are unstaged, so they stay in the working tree, and
+#         HEAD moves to origin/<branch> with git reset --merge, which only
+#         writes what differs between the two, like a fast-forward. The old
+#         HEAD is kept as BACKUP_REF.
+UP_TO_DATE = 'up_to_date'
+MERGE = 'merge'
+WIP_MERGE = 'wip_merge'
+RESET = 'reset'
+
+# Points at HEAD as it was before the last RESET
+BACKUP_REF = 'refs/nbpuller/backup'
+
+
+def _choose_strategy(backend, head, upstream, status, new_paths):
+    """
+    Returns how to bring the commit upstream into HEAD, given the
+    StatusSnapshot status after deleted files were reset and the paths newly
+    added to the sparse checkout, as (strategy, paths). paths are the ones
+    HEAD changed since the merge base, which RESET unstages, and empty for
+    the other strategies.
+
+    Local changes only need a WIP commit when they are in the way: when the
+    upstream changes since the merge base touch a changed or untracked path,
+    when a new sparse path would be checked out over one, or when anything
+    is staged, which git merge refuses to merge into. A merge commit is only
+    made when HEAD's own commits touch what changed upstream.
+    """
+    dirty = status.deleted | status.modified | status.added | \
+        status.untracked
+    if status.staged or _overlaps(dirty, new_paths):
+        return WIP_MERGE, []
+    if head == upstream:
+        return UP_TO_DATE, []
+
+    base = backend.merge_base(head, upstream)
+    if base is None:
+        return (WIP_MERGE if dirty else MERGE), []
+    if base == upstream:
+        return UP_TO_DATE, []
+    upstream_paths = backend.changed_paths(base, upstream)
+    if _overlaps(dirty, upstream_paths):
+        util.logger.info('Upstream changes overlap local changes')
+        return WIP_MERGE, []
+    if base == head:
+        # Fast-forward
+        return MERGE, []
+
+    local_paths = backend.changed_paths(base, head)
+    if _overlaps(local_paths, upstream_paths):
+        util.logger.info('Upstream changes overlap local commits')
+        return MERGE, []
+    return RESET, local_paths
+
+
+def _upstream_changes(backend, head, upstream):
+    """
+    Returns the paths that upstream changed since its merge base with head,
+    which merging it writes.
+    """
+    base = backend.merge_base(head, upstream)
+    if base is None:
+        # git merge refuses unrelated histories anyway
+        return []
+    return backend.changed_paths(base, upstream)
 
 
-def _pull_and_resolve_conflicts(repo, branch, progress=None):
+def _overlaps(paths, other_paths):
     """
-    Git pulls, resolving conflicts with -Xours
+    Returns whether any of paths is one of other_paths, or a directory
+    containing one of them or inside one of them.
     """
-    util.logger.info('Starting pull from {}'.format(repo.remotes['origin']))
+    other_paths = {path.strip('/') for path in other_paths}
+    if not other_paths:
+        return False
+
+    # Every directory above other_paths
+    other_parents = set()
+    for path in other_paths:
+        parent = os.path.dirname(path)
+        while parent and parent not in other_parents:
+            other_parents.add(parent)
+            parent = os.path.dirname(parent)
+
+    for path in paths:
+        path = path.strip('/')
+        if path in other_paths or path in other_parents:
+            return True
+        parent = os.path.dirname(path)
+        while parent:
+            if parent in other_paths:
+                return True
+            parent = os.path.dirname(parent)
+    return False
+
+
+def _pull_and_resolve_conflicts(repo, branch, sparse, strategy,
+                                local_paths):
+    """
+    Brings in the already fetched origin/<branch> as strategy (from
+    _choose_strategy, with its local_paths) says, resolving merge conflicts
+    with -Xours, then applies the saved SparseCheckout sparse to the working
+    tree if it changed.
+
+    Fast-forwards, merges and resets all only write the files that changed,
+    and leave files outside the sparse checkout alone, so the whole index is
+    only re-read for a new sparse checkout.
+    """
+    util.logger.info('Starting pull from {} ({})'.format(
+        repo.remotes['origin'], strategy))
 
     git_cli = repo.git
-
-    # Fetch then merge, resolving conflicts by keeping original content
-    repo.remote(name='origin').fetch(progress=progress)
-    git_cli.merge('-Xours', 'origin/' + branch)
+    if strategy == RESET:
+        with tracing.span('merge'):
+            # HEAD's own commits are left behind by the reset, so they are
+            # kept reachable (and in the ref's reflog) for maintenance
+            git_cli.update_ref('--create-reflog', '-m',
+                               'nbpuller: before reset', BACKUP_REF, 'HEAD')
+            if local_paths:
+                # The index entries go back to upstream's version, which
+                # reset --merge then keeps along with the working tree files
+                with _pathspec_file(repo, local_paths) as pathspec_args:
+                    git_cli.reset('-q', 'origin/' + branch, *pathspec_args)
+            git_cli.reset('-q', '--merge', 'origin/' + branch)
+    elif strategy != UP_TO_DATE:
+        # Merge, resolving conflicts by keeping original content
+        with tracing.span('merge'):
+            git_cli.merge('-Xours', 'origin/' + branch)
 
     # Ensure only files/folders in sparse-checkout are left
-    git_cli.read_tree('-mu', 'HEAD')
+    if sparse.changed:
+        with tracing.span('read_tree'):
+            git_cli.read_tree('-mu', 'HEAD')
 
     util.logger.info('Pulled from {}'.format(repo.remotes['origin']))
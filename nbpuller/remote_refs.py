@@ -0,0 +1,96 @@
+"""
+Remembers the commit each remote branch was last seen at, so pulls of a repo
+that was fetched moments ago (usually for another user) can skip fetching.
+
+Within REMOTE_FRESHNESS_TTL_S of the last fetch or check, the remembered
+commit is trusted as is. After that a single git ls-remote, which only
+transfers the ref advertisement, tells whether the branch moved. Only when it
+did does a pull have to fetch. An ls-remote that fails or takes longer than
+its timeout answers None, so callers fall back to fetching.
+"""
+import threading
+import time
+
+import git
+
+from . import tracing
+from . import util
+
+_lock = threading.Lock()
+# (repo_url, branch_name) -> (commit sha, time it was seen)
+_seen = {}
+_key_locks = {}
+
+
+def remote_head(repo_url, branch_name, ttl_s, timeout_s=None):
+    """
+    Returns the sha of the commit branch_name points to on the remote, or
+    None if it is unknown or ttl_s is 0 (the cache is disabled).
+
+    Concurrent callers for the same branch share a single ls-remote, which is
+    killed after timeout_s seconds.
+    """
+    if not ttl_s:
+        return None
+
+    key = (repo_url, branch_name)
+    with _key_lock(key):
+        with _lock:
+            seen = _seen.get(key)
+        if seen is not None and time.time() - seen[1] < ttl_s:
+            return seen[0]
+
+        sha = _ls_remote(repo_url, branch_name, timeout_s)
+        if sha is not None:
+            record(repo_url, branch_name, sha)
+        return sha
+
+
+def record(repo_url, branch_name, sha):
+    """Records that branch_name was just seen at sha on the remote."""
+    if sha is None:
+        return
+    with _lock:
+        _seen[(repo_url, branch_name)] = (sha, time.time())
+
+
+def forget(repo_url, branch_name):
+    """
+    Forgets where branch_name was seen, so the next remote_head asks the
+    remote.
+    """
+    with _lock:
+        _seen.pop((repo_url, branch_name), None)
+
+
+def ref_sha(repo, ref_path):
+    """
+    Returns the sha ref_path (eg. refs/remotes/origin/master) points to in
+    repo, or None if it doesn't exist. Reads the ref files directly instead of
+    running git.
+    """
+    try:
+        return git.SymbolicReference.dereference_recursive(repo, ref_path)
+    except (ValueError, OSError):
+        return None
+
+
+def _key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _ls_remote(repo_url, branch_name, timeout_s):
+    try:
+        output = tracing.TracedGit().ls_remote(
+            repo_url, 'refs/heads/' + branch_name,
+            kill_after_timeout=timeout_s or None)
+    except git.exc.GitCommandError as e:
+        util.logger.warning('ls-remote of {} failed: {}'.format(repo_url, e))
+        return None
+    for line in output.splitlines():
+        sha, _, ref = line.partition('\t')
+        if ref == 'refs/heads/' + branch_name:
+            util.logger.info('Remote {} is at {}'.format(branch_name, sha))
+            return sha
+    return None
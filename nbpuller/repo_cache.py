@@ -0,0 +1,103 @@
+"""
+Host-level cache of bare git mirrors shared by every user clone.
+
+There is one bare mirror per (domain, account, repo) under GIT_CACHE_PATH.
+User clones are made from the mirror with --shared, so they borrow its objects
+through .git/objects/info/alternates instead of downloading and storing their
+own copy of the pack. Only the mirror ever talks to the remote.
+"""
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+
+from . import tracing
+from . import util
+
+
+def mirror_dir(config, domain, account, repo_name):
+    """
+    Returns the path of the bare mirror for a repo, or None if the cache is
+    disabled (GIT_CACHE_PATH is empty).
+    """
+    cache_path = config['GIT_CACHE_PATH']
+    if not cache_path:
+        return None
+
+    # Domains are directories for file:// remotes
+    return os.path.join(os.path.abspath(cache_path),
+                        domain.strip('/'), account or '_', repo_name + '.git')
+
+
+@contextmanager
+def _mirror_lock(mirror):
+    """
+    Holds an exclusive lock on <mirror>.lock.
+
+    flock works across processes, so refreshes started by different notebook
+    servers on the same host are serialized too.
+    """
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    with open(mirror + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def refresh_mirror(repo_url, mirror, branch_name, progress=None):
+    """
+    Creates the bare mirror if it doesn't exist yet, otherwise fetches
+    branch_name into it from the remote.
+    """
+    with _mirror_lock(mirror):
+        if os.path.exists(mirror):
+            util.logger.info('Refreshing mirror {}'.format(mirror))
+            tracing.Repo(mirror).remote(name='origin').fetch(
+                _branch_refspec(branch_name), progress=progress)
+            return
+
+        util.logger.info('Creating mirror {} from {}'.format(mirror, repo_url))
+
+        # Clone next to the final location and rename it into place so that a
+        # crashed clone never leaves a half-populated mirror behind.
+        tmp_dir = mirror + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        repo = tracing.Repo.clone_from(repo_url, tmp_dir, progress, bare=True)
+
+        config = repo.config_writer()
+        config.set_value('remote "origin"', 'fetch', _branch_refspec('*'))
+        # User clones reference these objects through alternates, so the
+        # mirror must never prune objects that became unreachable after a
+        # force push.
+        config.set_value('gc', 'pruneExpire', 'never')
+        config.release()
+
+        os.rename(tmp_dir, mirror)
+
+
+def clone_from_mirror(mirror, repo_url, repo_dir, branch_name, **kwargs):
+    """
+    Clones repo_dir from the local mirror, sharing its objects, and points
+    origin back at the real remote url.
+
+    Extra kwargs are passed through to git clone.
+    """
+    repo = tracing.Repo.clone_from(mirror, repo_dir, branch=branch_name,
+                                   shared=True, **kwargs)
+    repo.remote(name='origin').set_url(repo_url)
+    return repo
+
+
+def fetch_from_mirror(repo, mirror, branch_name):
+    """
+    Updates origin/<branch_name> in a user clone from the local mirror. The
+    objects are already reachable through alternates, so nothing is copied.
+    """
+    repo.git.fetch(mirror, '+refs/heads/{0}:refs/remotes/origin/{0}'
+                   .format(branch_name))
+
+
+def _branch_refspec(branch_name):
+    return '+refs/heads/{0}:refs/heads/{0}'.format(branch_name)
@@ -0,0 +1,148 @@
+"""
+Bounded thread pool that shares its workers fairly between users and repos.
+
+Replaces a plain ThreadPoolExecutor, whose single FIFO queue lets one user
+with a huge pull (or many tabs) hold up everybody queued behind them.
+"""
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+class ServerBusy(Exception):
+    """
+    Raised by Scheduler.submit when the queue is full. retry_after is the
+    number of seconds the client should wait before trying again.
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(
+            self, 'Server busy, retry in {} s'.format(retry_after))
+        self.retry_after = retry_after
+
+
+class _Task(object):
+    def __init__(self, user, repo_key, fn, args, kwargs):
+        self.user = user
+        self.repo_key = repo_key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class Scheduler(object):
+    """
+    Runs submitted functions on max_workers threads.
+
+    Queued tasks are kept per user and workers take turns between users, so a
+    user with many queued tasks can't starve the others. At most one task per
+    repo_key runs at a time; a task whose repo is busy is skipped over in
+    favour of tasks for other repos until the repo is free again.
+
+    At most max_queue_depth tasks wait at once, further submits raise
+    ServerBusy.
+    """
+    def __init__(self, max_workers, max_queue_depth, retry_after_s):
+        self.max_queue_depth = max_queue_depth
+        self.retry_after_s = retry_after_s
+
+        self._cond = threading.Condition()
+        # user -> deque of queued tasks, in the order users get their turn
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running_repos = set()
+
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='nbpuller-worker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, user, repo_key, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) for user. Tasks with the same repo_key
+        never run concurrently; None means no such restriction.
+
+        Returns a concurrent.futures.Future of the result.
+        """
+        task = _Task(user, repo_key, fn, args, kwargs)
+        with self._cond:
+            if self._queued >= self.max_queue_depth:
+                raise ServerBusy(self.retry_after_s)
+            self._queues.setdefault(user, deque()).append(task)
+            self._queued += 1
+            self._cond.notify()
+        return task.future
+
+    def queue_depth(self):
+        """Returns the number of tasks waiting for a worker."""
+        with self._cond:
+            return self._queued
+
+    def position(self, future):
+        """
+        Returns how many queued tasks will start before the task of future,
+        or None if it isn't queued anymore.
+
+        This replays the round robin over the current queues, ignoring repos
+        that are busy right now, so it is an estimate.
+        """
+        with self._cond:
+            queues = [list(queue) for queue in self._queues.values()]
+
+        position = 0
+        longest = max([len(queue) for queue in queues] + [0])
+        for turn in range(longest):
+            for queue in queues:
+                if turn >= len(queue):
+                    continue
+                if queue[turn].future is future:
+                    return position
+                position += 1
+        return None
+
+    def _next_task(self):
+        """
+        Pops the next task to run, or returns None if every queued task
+        belongs to a busy repo. Must hold self._cond.
+        """
+        for user, queue in self._queues.items():
+            for task in queue:
+                if task.repo_key is None or \
+                        task.repo_key not in self._running_repos:
+                    break
+            else:
+                continue
+
+            queue.remove(task)
+            self._queued -= 1
+            # The user goes to the back of the line for their next task
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            return task
+
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+                if task.repo_key is not None:
+                    self._running_repos.add(task.repo_key)
+
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        result = task.fn(*task.args, **task.kwargs)
+                    except BaseException as e:
+                        task.future.set_exception(e)
+                    else:
+                        task.future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running_repos.discard(task.repo_key)
+                    self._cond.notify_all()
@@ -0,0 +1,241 @@
+"""
+Keeps .git/info/sparse-checkout of a user clone as a normalized set of paths.
+
+Every path is stored once, and paths inside a directory that is already
+checked out are dropped, so the file stays as small as what the user actually
+has instead of growing with every pull.
+
+When every path is a directory (or a file at the root, which cone mode always
+includes), the file is written in cone mode, where git matches directories
+with hash lookups instead of trying every pattern against every file.
+Otherwise it is written as plain patterns, one per path.
+"""
+import os
+
+# Paths with these characters are patterns and can't be used in cone mode
+GLOB_CHARS = set('*?[\\')
+
+
+class SparseCheckout(object):
+    """
+    The sparse-checkout paths of repo (a git.Repo), loaded from disk.
+
+    Changes made with add are kept in memory until save is called.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo.git_dir, 'info', 'sparse-checkout')
+        self.cone = _get_cone_config(repo)
+        self.changed = False
+
+        # path -> whether it is a directory, relative to the repo root
+        self.paths = {}
+        try:
+            with open(self.path) as info_file:
+                lines = info_file.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        parse = _parse_cone if self.cone else _parse_patterns
+        # Parents sort before what is inside them, which is dropped
+        for path, is_directory in sorted(parse(lines)):
+            if self.covers(path):
+                self.changed = True
+            else:
+                self.paths[path] = is_directory
+
+    def covers(self, path):
+        """
+        Returns whether path, or a directory containing it, is already
+        checked out.
+        """
+        path = _normalize(path)
+        while path:
+            if path in self.paths:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def add(self, path, is_directory=False):
+        """
+        Adds path, a file or a directory if is_directory.
+
+        Returns True if path wasn't checked out before.
+        """
+        path = _normalize(path)
+        if self.cone and not is_directory and '/' not in path:
+            # Root files are always checked out in cone mode and aren't
+            # written to the file, so remember it without changing anything
+            self.paths.setdefault(path, False)
+            return False
+
+        if self.covers(path):
+            # A legacy pattern may not have recorded that it is a directory
+            if is_directory and self.paths.get(path) is False:
+                self.paths[path] = True
+                self.changed = True
+            return False
+
+        if is_directory:
+            prefix = path + '/'
+            for inside in [p for p in self.paths if p.startswith(prefix)]:
+                del self.paths[inside]
+
+        self.paths[path] = is_directory
+        self.changed = True
+        return True
+
+    def remove(self, path):
+        """
+        Removes path, as given to add.
+
+        Returns True if it was there.
+        """
+        path = _normalize(path)
+        if path not in self.paths:
+            return False
+
+        del self.paths[path]
+        self.changed = True
+        return True
+
+    def save(self):
+        """
+        Writes the paths back if they changed, in cone mode if possible.
+
+        The file is replaced atomically, so a crash never leaves git with a
+        half-written pattern list.
+        """
+        if not self.changed:
+            return
+
+        cone = self._can_use_cone()
+        lines = _format_cone(self.paths) if cone \
+            else _format_patterns(self.paths)
+
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'w') as info_file:
+            info_file.write(''.join(line + '\n' for line in lines))
+        os.replace(tmp_path, self.path)
+
+        if cone != self.cone:
+            repo_config = self.repo.config_writer()
+            repo_config.set_value('core', 'sparseCheckoutCone', cone)
+            repo_config.release()
+            self.cone = cone
+
+    def cone_parents(self):
+        """
+        Returns the root ('') and every parent of a checked out directory.
+        In cone mode, the files directly inside them are checked out too.
+        """
+        return [''] + sorted(_parents(self.paths))
+
+    def _can_use_cone(self):
+        for path, is_directory in self.paths.items():
+            if GLOB_CHARS & set(path):
+                return False
+            if not is_directory and '/' in path:
+                return False
+        return True
+
+
+def _get_cone_config(repo):
+    reader = repo.config_reader(config_level='repository')
+    try:
+        return reader.get_value('core', 'sparseCheckoutCone', False) is True
+    finally:
+        reader.release()
+
+
+def _normalize(path):
+    return path.strip('/')
+
+
+def _escape(path):
+    """
+    Escapes spaces, which git would otherwise trim off the end of a pattern.
+    Glob characters are left alone so paths can still be patterns.
+    """
+    return path.replace(' ', '\\ ')
+
+
+def _unescape(pattern):
+    chars = []
+    escaped = False
+    for char in pattern:
+        if char == '\\' and not escaped:
+            escaped = True
+            continue
+        chars.append(char)
+        escaped = False
+    return ''.join(chars)
+
+
+def _parse_patterns(lines):
+    """
+    Yields (path, is_directory) for the lines of a non-cone file. Directories
+    have a trailing slash; older files don't mark them at all.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('!'):
+            continue
+        path = _normalize(_unescape(line))
+        if path:
+            yield path, line.endswith('/')
+
+
+def _parse_cone(lines):
+    """
+    Yields (path, True) for the recursively included directories of a cone
+    mode file. Those are the included directories that aren't only parents of
+    other ones, which git marks with a !/<parent>/*/ line.
+    """
+    included = []
+    parents = set()
+    for line in lines:
+        line = line.strip()
+        if line in ('/*', '!/*/'):
+            continue
+        if line.startswith('!') and line.endswith('/*/'):
+            parents.add(_normalize(_unescape(line[1:-3])))
+        elif line.endswith('/'):
+            included.append(_normalize(_unescape(line)))
+
+    for path in included:
+        if path and path not in parents:
+            yield path, True
+
+
+def _format_patterns(paths):
+    return ['/{}{}'.format(_escape(path), '/' if is_directory else '')
+            for path, is_directory in sorted(paths.items())]
+
+
+def _format_cone(paths):
+    """
+    Returns the lines of a cone mode file checking out every directory in
+    paths. Root files need no line, cone mode always includes them.
+    """
+    directories = sorted(path for path, is_directory in paths.items()
+                         if is_directory)
+
+    lines = ['/*', '!/*/']
+    for parent in sorted(_parents(paths)):
+        lines += ['/{}/'.format(parent), '!/{}/*/'.format(parent)]
+    lines += ['/{}/'.format(path) for path in directories]
+    return lines
+
+
+def _parents(paths):
+    """Returns the set of directories containing a directory in paths."""
+    parents = set()
+    for path, is_directory in paths.items():
+        if not is_directory:
+            continue
+        parent = os.path.dirname(path)
+        while parent:
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+    return parents
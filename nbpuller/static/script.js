@@ -14,23 +14,53 @@ function updateStatus(payload) {
   $('.status').html(payload);
 }
 
+// The payload is either the url or an object with the url and extra details
 function handleRedirect(payload) {
-  $('.status').html('Redirecting you to ' + payload);
-  window.location.href = payload;
+  var url = typeof payload === 'string' ? payload : payload.url;
+  $('.status').html('Redirecting you to ' + url);
+  window.location.href = url;
 }
 
 function updateLog(payload) {
   $('.log').html(payload + '\n');
 }
 
+// Number of finished progress lines kept in the log
+var MAX_LOG_LINES = 10;
+var logLines = [];
+
+// Progress messages only carry the lines added since the previous one
+function updateProgress(payload) {
+  logLines = logLines.concat(payload.lines).slice(-MAX_LOG_LINES);
+
+  var text = logLines.join('\n');
+  if (payload.current) {
+    text += '\n' + payload.current;
+  }
+  updateLog(text);
+
+  if (payload.phase) {
+    var percent = payload.percent === null ? '' : ' ' + payload.percent + '%';
+    updateStatus(payload.phase + percent);
+  }
+}
+
 function showError(payload) {
   updateStatus(payload.message);
   showProceedLink(payload.proceed_url);
+
+  // The server was too busy to queue the request, try again later
+  if (payload.retry_after) {
+    setTimeout(function() {
+      window.location.reload();
+    }, payload.retry_after * 1000);
+  }
 }
 
 // Keep in sync with messages.py
 var messageHandlers = {
   'LOG': updateLog,
+  'PROGRESS': updateProgress,
   'STATUS': updateStatus,
   'REDIRECT': handleRedirect,
   'ERROR': showError,
@@ -0,0 +1,151 @@
+"""
+Per-request traces of pulls and downloads.
+
+A Trace records a span for each step of a request with its wall time, the
+git subprocesses it started and the bytes it transferred. Each span is also
+recorded in the nbpuller_phase_seconds metric. The summary of the trace is
+attached to the final message sent to the client, and logged as JSON when
+TRACE_LOG is set, so a slow request can be looked up afterwards by its id.
+
+Git commands are counted by TracedGit, which Repo uses to run them. Pulls run
+on a single worker thread, so their trace is found through activate() and
+span() without passing it around. Downloads are coroutines sharing the
+IOLoop thread and use their Trace directly.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import git
+
+from . import metrics
+
+_local = threading.local()
+
+trace_logger = logging.getLogger('app.trace')
+
+
+class Trace(object):
+    """The spans of one pull or download; operation is 'pull' or 'download'."""
+    def __init__(self, operation):
+        self.operation = operation
+        self.request_id = uuid.uuid4().hex[:16]
+        self.spans = []
+        self.started = time.monotonic()
+        self.finished = None
+        # Totals, including what happened outside of any span
+        self.subprocesses = 0
+        self.bytes = 0
+        # Progress callbacks report bytes from git's output threads
+        self._lock = threading.Lock()
+        self._open = []
+
+    @contextmanager
+    def span(self, name):
+        """Records the with block as a step called name."""
+        span = {'name': name, 'ms': 0, 'subprocesses': 0, 'bytes': 0}
+        start = time.monotonic()
+        with self._lock:
+            self._open.append(span)
+        try:
+            yield span
+        finally:
+            elapsed = time.monotonic() - start
+            span['ms'] = int(elapsed * 1000)
+            with self._lock:
+                self._open.remove(span)
+                self.spans.append(span)
+            metrics.PHASE_SECONDS.observe(elapsed, self.operation, name)
+
+    def add_subprocess(self):
+        self._add('subprocesses', 1)
+
+    def add_bytes(self, amount):
+        self._add('bytes', amount)
+
+    def _add(self, field, amount):
+        """Adds amount to field of the trace and its innermost open span."""
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+            if self._open:
+                self._open[-1][field] += amount
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def summary(self):
+        """Returns the compact summary sent to the client and logged."""
+        end = self.finished if self.finished is not None else time.monotonic()
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'request_id': self.request_id,
+            'total_ms': int((end - self.started) * 1000),
+            'subprocesses': self.subprocesses,
+            'bytes': self.bytes,
+            'spans': spans,
+        }
+
+    def attach(self, message, config):
+        """
+        Finishes the trace and adds its summary to message as 'timing'.
+        Plain string redirect payloads become {'url': payload}.
+
+        Returns message.
+        """
+        self.finish()
+        summary = self.summary()
+        if config['TRACE_LOG']:
+            trace_logger.info(json.dumps(dict(
+                summary, operation=self.operation, type=message['type'])))
+
+        payload = message['payload']
+        if isinstance(payload, str) and message['type'] == 'REDIRECT':
+            payload = {'url': payload}
+        if isinstance(payload, dict):
+            message['payload'] = dict(payload, timing=summary)
+        return message
+
+
+@contextmanager
+def activate(trace):
+    """Makes trace the current trace of this thread in the with block."""
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def current():
+    """Returns the current trace of this thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(name):
+    """Records the with block as a span of the current trace, if any."""
+    trace = current()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name) as span:
+        yield span
+
+
+class TracedGit(git.Git):
+    """Runs git commands, counting them in the current trace."""
+    def execute(self, command, *args, **kwargs):
+        trace = current()
+        if trace is not None:
+            trace.add_subprocess()
+        return git.Git.execute(self, command, *args, **kwargs)
+
+
+class Repo(git.Repo):
+    """git.Repo running its commands through TracedGit."""
+    GitCommandWrapperType = TracedGit
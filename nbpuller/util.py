@@ -1,6 +1,11 @@
 import os
+import grp
+import stat
+import pwd
+import fcntl
 import shutil
 import logging
+from functools import lru_cache
 
 """
 Format for downloading zip files of Git folders
@@ -19,6 +24,9 @@ logging.basicConfig(
     level=logging.DEBUG)
 logger = logging.getLogger('app')
 
+# ioctl request that reflinks one file to another, from linux/fs.h
+FICLONE = 0x40049409
+
 
 def chown(path, filename):
     """Set owner and group of file to that of the parent directory."""
@@ -26,15 +34,118 @@ def chown(path, filename):
     os.chown(os.path.join(path, filename), s.st_uid, s.st_gid)
 
 
-def chown_dir(directory, username):
-    """Set owner and group of directory to username."""
-    shutil.chown(directory, username, username)
-    for root, dirs, files in os.walk(directory):
-        for child in dirs + files:
-            shutil.chown(os.path.join(root, child), username, username)
+@lru_cache(maxsize=None)
+def user_ids(username):
+    """
+    Returns the (uid, gid) of the user and group named username. Cached so
+    that chowning many files doesn't look the names up every time.
+    """
+    return pwd.getpwnam(username).pw_uid, grp.getgrnam(username).gr_gid
+
+
+def chown_dir(directory, username, keep_shared=False):
+    """
+    Set owner and group of directory and everything in it to username.
+
+    With keep_shared, files with more than one hard link are left alone.
+    """
+    uid, gid = user_ids(username)
+    os.chown(directory, uid, gid)
+    _chown_tree(directory, uid, gid, keep_shared=keep_shared)
     logger.info("{} chown'd to {}".format(directory, username))
 
 
+def chown_repo_changes(repo_dir, username, paths, since, keep_shared=False):
+    """
+    Set owner and group to username for what a pull changed in repo_dir.
+
+    paths are the working tree files and directories (relative to repo_dir)
+    the pull wrote; directories are chowned with everything in them, files
+    together with their parent directories. Missing paths were deleted and
+    are skipped.
+
+    In .git, only entries of directories modified at or after since (a
+    timestamp from the same clock as the file system) are chowned. Git always
+    writes files by creating or renaming them, which updates the mtime of
+    their directory.
+
+    With keep_shared, files with more than one hard link are left alone.
+    """
+    uid, gid = user_ids(username)
+    dir_fd = os.open(repo_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        to_chown = set()
+        for path in paths:
+            path = path.strip('/')
+            if os.path.isdir(os.path.join(repo_dir, path)):
+                _chown_tree(os.path.join(repo_dir, path), uid, gid,
+                            keep_shared=keep_shared)
+            to_chown.add(path)
+
+            parent = os.path.dirname(path)
+            while parent:
+                to_chown.add(parent)
+                parent = os.path.dirname(parent)
+
+        for path in to_chown:
+            try:
+                _chown(path, uid, gid, dir_fd, keep_shared)
+            except FileNotFoundError:
+                pass
+    finally:
+        os.close(dir_fd)
+
+    _chown_tree(os.path.join(repo_dir, '.git'), uid, gid, since=since)
+    logger.info("Changes in {} chown'd to {}".format(repo_dir, username))
+
+
+def _chown_tree(directory, uid, gid, since=None, keep_shared=False):
+    """
+    Chowns everything below directory with calls relative to directory file
+    descriptors. If since is given, entries of directories that weren't
+    modified since then are skipped (their subdirectories are still visited).
+    """
+    for root, dirs, files, root_fd in os.fwalk(directory):
+        if since is not None and os.fstat(root_fd).st_mtime < since:
+            continue
+        for name in dirs:
+            os.chown(name, uid, gid, dir_fd=root_fd, follow_symlinks=False)
+        for name in files:
+            _chown(name, uid, gid, root_fd, keep_shared)
+
+
+def _chown(name, uid, gid, dir_fd, keep_shared):
+    """
+    Chowns name, relative to dir_fd. With keep_shared, regular files with
+    more than one hard link are skipped: they are shared with other users
+    (see dedup.py), who would all get write access to them.
+    """
+    if keep_shared:
+        info = os.lstat(name, dir_fd=dir_fd)
+        if stat.S_ISREG(info.st_mode) and info.st_nlink > 1:
+            return
+    os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+
+
+def clone_file(source, target):
+    """
+    Copies source to target. The copy shares the data blocks of source (a
+    reflink) on file systems that support it, like btrfs or XFS, and is a
+    plain copy otherwise. Either way target is independent of source.
+
+    Returns True if target is a reflink.
+    """
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            pass
+
+    shutil.copyfile(source, target)
+    return False
+
+
 def construct_path(path, format, *args):
     """Constructs a path using locally available variables."""
     return os.path.join(path.format(**format), *args)
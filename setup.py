@@ -10,6 +10,15 @@ setuptools.setup(
     install_requires=[
         'notebook', 'pytest', 'webargs', 'requests', 'gitpython', 'toolz'
     ],
+    extras_require={
+        # Reuses connections to file_url origins between downloads
+        'curl': ['pycurl'],
+        # GIT_BACKEND=pygit2
+        'pygit2': ['pygit2'],
+    },
     package_data={'nbpuller': ['static/*']},
+    entry_points={
+        'console_scripts': ['nbpuller-prewarm = nbpuller.prewarm:main'],
+    },
 )
 .12
@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks pull_from_remote against generated local git repos.
+
+Builds a bare repo of the requested size with git fast-import, serves it to
+nbpuller as a file:// remote and times these scenarios:
+
+    first_clone      pull into a user directory that doesn't exist yet
+    noop_pull        pull again with nothing changed anywhere
+    upstream_change  pull after new commits upstream
+    local_conflict   pull after editing files that also changed upstream
+    many_paths       first pull of every directory as a separate path
+    many_deleted     pull after deleting every pulled file locally
+
+Each scenario runs --repeat times with its own users. Timings, git
+subprocess counts and the slowest steps come from the 'timing' summary of the
+final message. Nothing touches the network, so results can be compared
+between commits:
+
+    python3 tests/benchmark.py --dirs 20 --files 50 --history 200
+    python3 tests/benchmark.py --json > before.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nbpuller import dedup, git_backend, remote_refs  # noqa: E402
+from nbpuller.config import TestConfig  # noqa: E402
+from nbpuller.pull_from_remote import (  # noqa: E402
+    pull_from_remote, remote_url)
+
+BRANCH = 'gh-pages'
+REPO = 'assets'
+SCENARIOS = ['first_clone', 'noop_pull', 'upstream_change',
+             'local_conflict', 'many_paths', 'many_deleted']
+
+
+class Fixture(object):
+    """
+    A generated bare repo of dirs directories with files files each, and
+    the directories users pull it into. The other arguments are the
+    nbpuller settings the pulls use.
+    """
+    def __init__(self, root, dirs=10, files=20, history=50, blob_size=20000,
+                 seed=0, cache=False, clone_mode='full', freshness_ttl=0,
+                 git_backend='cli', dedup='', dedup_min_bytes=10000):
+        self.root = root
+        self.dirs = dirs
+        self.files_per_dir = files
+        self.history = history
+        self.blob_size = blob_size
+        self.remotes = os.path.join(root, 'remotes')
+        self.remote = os.path.join(self.remotes, REPO + '.git')
+        self.random = random.Random(seed)
+        self.commits = 0
+
+        class Config(TestConfig):
+            COPY_PATH = os.path.join(root, 'home', '{username}')
+            GIT_REDIRECT_PATH = '/tree/{destination}'
+            GIT_URL_SCHEME = 'file'
+            ALLOWED_WEB_DOMAINS = [self.remotes]
+            GIT_CACHE_PATH = os.path.join(root, 'cache') if cache else ''
+            GIT_CLONE_MODE = clone_mode
+            REMOTE_FRESHNESS_TTL_S = freshness_ttl
+            GIT_BACKEND = git_backend
+            DEDUP_MODE = dedup
+            DEDUP_STORE_PATH = os.path.join(root, 'store')
+            DEDUP_MIN_BYTES = dedup_min_bytes
+
+        self.config = Config('/')
+
+    def directories(self):
+        return ['labs/lab{:03d}'.format(d) for d in range(self.dirs)]
+
+    def files(self, directory):
+        return ['{}/file{:03d}.ipynb'.format(directory, f)
+                for f in range(self.files_per_dir)]
+
+    def build(self):
+        """Creates the bare repo with history commits."""
+        os.makedirs(self.remote)
+        _git(self.remote, 'init', '--bare', '-q')
+        _git(self.remote, 'symbolic-ref', 'HEAD', 'refs/heads/' + BRANCH)
+
+        changes = {'.gitignore': b'.ipynb_checkpoints\n'}
+        for directory in self.directories():
+            for path in self.files(directory):
+                changes[path] = self._blob()
+        self.commit(changes)
+
+        every_file = [path for directory in self.directories()
+                      for path in self.files(directory)]
+        for _ in range(self.history - 1):
+            self.commit({self.random.choice(every_file): self._blob()})
+
+    def commit(self, changes):
+        """Commits changes ({path: contents}) upstream with fast-import."""
+        self.commits += 1
+        message = 'commit {}'.format(self.commits).encode()
+        stream = [
+            b'commit refs/heads/' + BRANCH.encode(),
+            'committer Bench <bench@example.com> {} +0000'.format(
+                1500000000 + self.commits).encode(),
+            b'data ' + str(len(message)).encode(),
+            message,
+        ]
+        if self.commits > 1:
+            stream.append(b'from refs/heads/' + BRANCH.encode() + b'^0')
+        for path, contents in sorted(changes.items()):
+            stream += [
+                b'M 100644 inline ' + path.encode(),
+                b'data ' + str(len(contents)).encode(),
+                contents,
+            ]
+        stream.append(b'')
+
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=self.remote,
+                       input=b'\n'.join(stream) + b'\n', check=True)
+
+    def change_upstream(self, paths):
+        """Changes paths upstream and adds a new file next to the first."""
+        changes = {path: self._blob() for path in paths}
+        new_file = '{}/new{:05d}.ipynb'.format(
+            os.path.dirname(paths[0]), self.commits)
+        changes[new_file] = self._blob()
+        self.commit(changes)
+        # As if REMOTE_FRESHNESS_TTL_S had passed since the push, otherwise
+        # the pull wouldn't see it
+        remote_refs.forget(
+            remote_url(self.config, self.remotes, '', REPO), BRANCH)
+
+    def check_pulled(self, username):
+        """Raises RuntimeError if username's HEAD doesn't have upstream."""
+        upstream = subprocess.run(
+            ['git', 'rev-parse', 'refs/heads/' + BRANCH], cwd=self.remote,
+            check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout.strip()
+        if subprocess.run(['git', 'merge-base', '--is-ancestor', upstream,
+                           'HEAD'], cwd=self.repo_dir(username)).returncode:
+            raise RuntimeError(
+                "{} didn't get upstream's {}".format(username, upstream))
+
+    def repo_dir(self, username):
+        return os.path.join(self.root, 'home', username, REPO)
+
+    def pull(self, username, paths):
+        """
+        Pulls paths for username. Returns the final message and the wall
+        time in ms.
+        """
+        start = time.monotonic()
+        message = pull_from_remote(
+            username=username,
+            repo_name=REPO,
+            branch_name=BRANCH,
+            paths=paths,
+            config=self.config,
+            progress=None,
+            notebook_path='',
+            account='',
+            domain=self.remotes,
+        )
+        return message, (time.monotonic() - start) * 1000
+
+    def _blob(self):
+        size = self.blob_size
+        return self.random.getrandbits(size * 4).to_bytes(
+            size // 2 + 1, 'little').hex()[:size].encode()
+
+
+def _git(cwd, *args):
+    subprocess.run(('git',) + args, cwd=cwd, check=True)
+
+
+def run_scenario(fixture, name, repeat):
+    """
+    Runs scenario name. Only the pull being measured is timed, not the
+    set up before it.
+
+    Returns the final message of that pull and its wall time in ms.
+    """
+    directories = fixture.directories()
+    first = directories[0]
+    username = 'bench-{}-{}'.format(name, repeat)
+
+    if name == 'first_clone':
+        return fixture.pull(username, [first])
+
+    if name == 'many_paths':
+        return fixture.pull(username, directories)
+
+    _check(fixture.pull(username, [first])[0])
+    repo_dir = fixture.repo_dir(username)
+    pulled_files = fixture.files(first)
+
+    if name == 'upstream_change':
+        fixture.change_upstream(pulled_files[:3])
+    elif name == 'local_conflict':
+        for path in pulled_files[:3]:
+            with open(os.path.join(repo_dir, path), 'a') as edited:
+                edited.write('student edit\n')
+        fixture.change_upstream(pulled_files[:3])
+    elif name == 'many_deleted':
+        for path in pulled_files:
+            os.remove(os.path.join(repo_dir, path))
+
+    result = fixture.pull(username, [first])
+    if name in ('upstream_change', 'local_conflict'):
+        _check(result[0])
+        fixture.check_pulled(username)
+    return result
+
+
+def _check(message):
+    if message['type'] == 'ERROR':
+        raise RuntimeError('Pull failed: {}'.format(message['payload']))
+
+
+def summarize(name, runs):
+    """Returns the summary of a scenario's runs as a dict."""
+    times = [ms for _, ms in runs]
+    timings = [message['payload']['timing'] for message, _ in runs]
+
+    # The steps that took longest in the median run
+    median_run = sorted(timings, key=lambda timing: timing['total_ms'])[
+        len(timings) // 2]
+    slowest = sorted(median_run['spans'], key=lambda span: -span['ms'])[:3]
+
+    return {
+        'scenario': name,
+        'runs': len(runs),
+        'median_ms': round(statistics.median(times), 1),
+        'min_ms': round(min(times), 1),
+        'max_ms': round(max(times), 1),
+        'subprocesses': statistics.median_low(
+            timing['subprocesses'] for timing in timings),
+        'slowest_steps': ['{} {}ms'.format(span['name'], span['ms'])
+                          for span in slowest],
+    }
+
+
+def print_table(results):
+    print('{:<16} {:>5} {:>10} {:>10} {:>10} {:>6}  {}'.format(
+        'scenario', 'runs', 'median ms', 'min ms', 'max ms', 'procs',
+        'slowest steps'))
+    for result in results:
+        print('{scenario:<16} {runs:>5} {median_ms:>10} {min_ms:>10} '
+              '{max_ms:>10} {subprocesses:>6}  {steps}'.format(
+                  steps=', '.join(result['slowest_steps']), **result))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dirs', type=int, default=10,
+                        help='directories in the generated repo')
+    parser.add_argument('--files', type=int, default=20,
+                        help='files per directory')
+    parser.add_argument('--history', type=int, default=50,
+                        help='number of commits in the generated repo')
+    parser.add_argument('--blob-size', type=int, default=20000,
+                        help='size of each file in bytes')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each scenario')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument('--cache', action='store_true',
+                        help='use a host-level mirror (GIT_CACHE_PATH)')
+    parser.add_argument('--clone-mode', default='full',
+                        choices=['full', 'blobless', 'shallow'])
+    parser.add_argument('--freshness-ttl', type=int, default=0,
+                        help='REMOTE_FRESHNESS_TTL_S, 0 fetches every time')
+    parser.add_argument('--git-backend', default='cli',
+                        choices=git_backend.BACKENDS)
+    parser.add_argument('--dedup', default='', choices=dedup.MODES,
+                        help='DEDUP_MODE, off by default')
+    parser.add_argument('--dedup-min-bytes', type=int, default=10000,
+                        help='DEDUP_MIN_BYTES')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the generated repos")
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show nbpuller's log")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    # WIP commits need an identity even where git isn't configured
+    for name in ('AUTHOR', 'COMMITTER'):
+        os.environ.setdefault('GIT_{}_NAME'.format(name), 'Bench')
+        os.environ.setdefault('GIT_{}_EMAIL'.format(name), 'bench@example.com')
+
+    root = tempfile.mkdtemp(prefix='nbpuller-bench-')
+    try:
+        fixture = Fixture(
+            root,
+            dirs=args.dirs,
+            files=args.files,
+            history=args.history,
+            blob_size=args.blob_size,
+            seed=args.seed,
+            cache=args.cache,
+            clone_mode=args.clone_mode,
+            freshness_ttl=args.freshness_ttl,
+            git_backend=args.git_backend,
+            dedup=args.dedup,
+            dedup_min_bytes=args.dedup_min_bytes,
+        )
+        start = time.monotonic()
+        fixture.build()
+        if not args.json:
+            print('Built {} commits of {} files in {:.1f}s under {}\n'.format(
+                args.history, args.dirs * args.files,
+                time.monotonic() - start, root))
+
+        results = []
+        for name in args.scenarios:
+            runs = []
+            for repeat in range(args.repeat):
+                message, ms = run_scenario(fixture, name, repeat)
+                _check(message)
+                runs.append((message, ms))
+            results.append(summarize(name, runs))
+
+        if args.json:
+            print(json.dumps({'args': vars(args), 'results': results},
+                             indent=2))
+        else:
+            print_table(results)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+
+"""
+Load test of the nbpuller handlers with many users clicking interact links
+at once.
+
+Starts the routes from setup_handlers in-process on a local port, with a
+generated git repo served as a file:// remote (see benchmark.py) and a local
+HTTP server for file_url links. Then --users simulated students each load
+the landing page and open the websocket to socket/<username>, like the
+browser does, and wait for the redirect:
+
+    python3 tests/load_test.py --users 300 --workers 4
+    python3 tests/load_test.py --users 100 --ramp 10 --file-fraction 0.2
+
+Reports p50/p95/p99 time to redirect, throughput, the deepest the pull queue
+got and how many requests failed, were turned away as busy or timed out.
+Users whose checkout is already current are redirected by the landing page
+itself, which is counted as fast_redirect as well.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from tornado import gen, httpclient, netutil, web, websocket
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Seconds between samples of the pull queue depth
+QUEUE_SAMPLE_S = 0.1
+
+# Tells the landing page which simulated user is asking
+USER_HEADER = 'X-Load-Test-User'
+
+
+class Results(object):
+    """Outcomes of the simulated users."""
+    def __init__(self):
+        self.redirect_s = []
+        self.outcomes = {}
+        self.max_queue_depth = 0
+
+    def add(self, outcome, elapsed=None):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if outcome == 'redirect':
+            self.redirect_s.append(elapsed)
+
+
+@gen.coroutine
+def simulate_user(base_url, username, query, timeout_s, results):
+    """
+    Loads the landing page for query, then opens the websocket and waits for
+    the final message.
+    """
+    start = time.monotonic()
+    deadline = IOLoop.current().time() + timeout_s
+    try:
+        landing = yield httpclient.AsyncHTTPClient().fetch(
+            '{}/interact?{}'.format(base_url, query),
+            headers={USER_HEADER: username},
+            follow_redirects=False, raise_error=False)
+        if landing.code == 302:
+            # The checkout was already current
+            results.add('redirect', time.monotonic() - start)
+            results.add('fast_redirect')
+            return
+        landing.rethrow()
+
+        socket_url = '{}/socket/{}?{}'.format(
+            base_url.replace('http', 'ws', 1), username, query)
+        connection = yield websocket.websocket_connect(socket_url)
+        try:
+            while True:
+                raw = yield gen.with_timeout(
+                    deadline, connection.read_message())
+                if raw is None:
+                    results.add('closed')
+                    return
+                message = json.loads(raw)
+                if message['type'] == 'REDIRECT':
+                    results.add('redirect', time.monotonic() - start)
+                    return
+                if message['type'] == 'ERROR':
+                    payload = message['payload']
+                    busy = isinstance(payload, dict) and \
+                        'retry_after' in payload
+                    results.add('busy' if busy else 'error')
+                    return
+        finally:
+            connection.close()
+    except gen.TimeoutError:
+        results.add('timeout')
+    except Exception:
+        logging.exception('User {} failed'.format(username))
+        results.add('error')
+
+
+@gen.coroutine
+def arrive(delay, *user_args):
+    """Runs simulate_user(*user_args) after delay seconds."""
+    if delay:
+        yield gen.sleep(delay)
+    yield simulate_user(*user_args)
+
+
+def build_queries(fixture, file_url, args, rng):
+    """Returns the interact query string of each user."""
+    # Students mostly click the same few links
+    links = [[('repo', 'assets'), ('branch', 'gh-pages'),
+              ('path', directory), ('domain', fixture.remotes)]
+             for directory in fixture.directories()[:args.links]]
+
+    queries = []
+    for _ in range(args.users):
+        if rng.random() < args.file_fraction:
+            queries.append(urllib.parse.urlencode([('file_url', file_url)]))
+        else:
+            queries.append(urllib.parse.urlencode(rng.choice(links)))
+    return queries
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(results, wall_s, args):
+    summary = {
+        'users': args.users,
+        'workers': args.workers,
+        'wall_s': round(wall_s, 2),
+        'throughput_per_s': round(len(results.redirect_s) / wall_s, 2),
+        'outcomes': results.outcomes,
+        'failure_rate': round(
+            1 - len(results.redirect_s) / float(args.users), 3),
+        'max_queue_depth': results.max_queue_depth,
+    }
+    if results.redirect_s:
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            summary[name + '_s'] = round(
+                percentile(results.redirect_s, fraction), 3)
+        summary['mean_s'] = round(statistics.mean(results.redirect_s), 3)
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100,
+                        help='simulated students')
+    parser.add_argument('--ramp', type=float, default=0,
+                        help='seconds over which users arrive, 0 for all '
+                             'at once')
+    parser.add_argument('--links', type=int, default=3,
+                        help='distinct interact links the users click')
+    parser.add_argument('--file-fraction', type=float, default=0,
+                        help='fraction of users clicking a file_url link')
+    parser.add_argument('--warm', action='store_true',
+                        help='clone for every user before the test, so it '
+                             'measures pulls into existing repos')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds a user waits for the redirect')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='PULL_WORKERS')
+    parser.add_argument('--queue-depth', type=int, default=100,
+                        help='PULL_QUEUE_DEPTH')
+    parser.add_argument('--cache', action='store_true',
+                        help='use a host-level mirror (GIT_CACHE_PATH)')
+    parser.add_argument('--clone-mode', default='full',
+                        choices=['full', 'blobless', 'shallow'])
+    parser.add_argument('--freshness-ttl', type=int, default=0,
+                        help='REMOTE_FRESHNESS_TTL_S, 0 fetches every time')
+    parser.add_argument('--git-backend', default='cli',
+                        choices=['cli', 'pygit2'])
+    parser.add_argument('--dedup', default='',
+                        choices=['', 'hardlink', 'reflink'],
+                        help='DEDUP_MODE, off by default')
+    parser.add_argument('--dedup-min-bytes', type=int, default=10000,
+                        help='DEDUP_MIN_BYTES')
+    parser.add_argument('--dirs', type=int, default=10,
+                        help='directories in the generated repo')
+    parser.add_argument('--files', type=int, default=20,
+                        help='files per directory')
+    parser.add_argument('--history', type=int, default=50,
+                        help='number of commits in the generated repo')
+    parser.add_argument('--blob-size', type=int, default=20000,
+                        help='size of each file in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the generated repos and user "
+                             "directories")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show nbpuller's log")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix='nbpuller-load-')
+
+    app_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    file_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    app_port = app_sockets[0].getsockname()[1]
+    file_port = file_sockets[0].getsockname()[1]
+
+    # The config is read from the environment when nbpuller is imported
+    os.environ.update({
+        'PULL_WORKERS': str(args.workers),
+        'PULL_QUEUE_DEPTH': str(args.queue_depth),
+        'GIT_URL_SCHEME': 'file',
+        'GIT_CLONE_MODE': args.clone_mode,
+        'ALLOWED_WEB_DOMAINS': os.path.join(root, 'remotes'),
+        'REMOTE_FRESHNESS_TTL_S': str(args.freshness_ttl),
+        'GIT_BACKEND': args.git_backend,
+        'GIT_CACHE_PATH': os.path.join(root, 'cache') if args.cache else '',
+        'DEDUP_MODE': args.dedup,
+        'DEDUP_STORE_PATH': os.path.join(root, 'store'),
+        'DEDUP_MIN_BYTES': str(args.dedup_min_bytes),
+    })
+    for name in ('AUTHOR', 'COMMITTER'):
+        os.environ.setdefault('GIT_{}_NAME'.format(name), 'Load test')
+        os.environ.setdefault('GIT_{}_EMAIL'.format(name),
+                              'load@example.com')
+
+    from benchmark import Fixture
+    from nbpuller import handlers
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    fixture = Fixture(
+        root,
+        dirs=args.dirs,
+        files=args.files,
+        history=args.history,
+        blob_size=args.blob_size,
+        seed=args.seed,
+        cache=args.cache,
+        clone_mode=args.clone_mode,
+        freshness_ttl=args.freshness_ttl,
+        git_backend=args.git_backend,
+        dedup=args.dedup,
+        dedup_min_bytes=args.dedup_min_bytes,
+    )
+    fixture.build()
+
+    www = os.path.join(root, 'www')
+    os.makedirs(www)
+    with open(os.path.join(www, 'notebook.ipynb'), 'w') as notebook:
+        notebook.write(json.dumps({'cells': [], 'nbformat': 4}))
+    file_url = 'http://127.0.0.1:{}/notebook.ipynb'.format(file_port)
+
+    # There is no hub to log the users in
+    handlers.LandingHandler.get_current_user = \
+        lambda handler: {'name': handler.request.headers.get(USER_HEADER)}
+
+    app = web.Application(base_url='/')
+    handlers.setup_handlers(app)
+    config = handlers.options.config
+    config.COPY_PATH = os.path.join(root, 'home', '{username}')
+    # Set here since the ':' in host:port is the environment's delimiter
+    config.ALLOWED_URL_DOMAIN = ['127.0.0.1:{}'.format(file_port)]
+    HTTPServer(app).add_sockets(app_sockets)
+    HTTPServer(web.Application([
+        (r'/(.*)', web.StaticFileHandler, {'path': www}),
+    ])).add_sockets(file_sockets)
+
+    queries = build_queries(fixture, file_url, args, rng)
+    usernames = ['student{:05d}'.format(i) for i in range(args.users)]
+    results = Results()
+
+    if args.warm:
+        for username, query in zip(usernames, queries):
+            if 'path=' in query:
+                fixture.pull(username, [urllib.parse.parse_qs(
+                    query)['path'][0]])
+
+    def sample_queue():
+        results.max_queue_depth = max(results.max_queue_depth,
+                                      handlers.scheduler.queue_depth())
+
+    @gen.coroutine
+    def run():
+        base_url = 'http://127.0.0.1:{}'.format(app_port)
+        sampler = PeriodicCallback(sample_queue, QUEUE_SAMPLE_S * 1000)
+        sampler.start()
+
+        start = time.monotonic()
+        yield gen.multi([
+            arrive(args.ramp * i / args.users, base_url, username, query,
+                   args.timeout, results)
+            for i, (username, query) in enumerate(zip(usernames, queries))
+        ])
+        sampler.stop()
+        return time.monotonic() - start
+
+    httpclient.AsyncHTTPClient.configure(None, max_clients=args.users)
+    try:
+        wall_s = IOLoop.current().run_sync(run)
+        print(json.dumps(report(results, wall_s, args), indent=2))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
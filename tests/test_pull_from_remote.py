@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+
+"""
+Tests of how pull_from_remote brings upstream changes into a user's clone
+(see _choose_strategy), against a local bare repo.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nbpuller import pull_from_remote as pfr  # noqa: E402
+from nbpuller import config as nbpuller_config  # noqa: E402
+
+BRANCH = 'gh-pages'
+REPO = 'assets'
+USERNAME = 'student'
+
+
+def _git(cwd, *args):
+    return subprocess.run(('git',) + args, cwd=cwd, check=True,
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip()
+
+
+class PullStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nbpuller-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        env = mock.patch.dict(os.environ, {
+            'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+            'GIT_COMMITTER_NAME': 'Test',
+            'GIT_COMMITTER_EMAIL': 'test@example.com',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        self.remotes = os.path.join(self.root, 'remotes')
+        remote = os.path.join(self.remotes, REPO)
+        os.makedirs(remote)
+        _git(remote, 'init', '-q', '--bare')
+        _git(remote, 'symbolic-ref', 'HEAD', 'refs/heads/' + BRANCH)
+
+        self.upstream = os.path.join(self.root, 'upstream')
+        _git(self.root, 'clone', '-q', remote, self.upstream)
+        _git(self.upstream, 'checkout', '-q', '-b', BRANCH)
+        self.push({
+            'labs/lab01/a.txt': 'a\n',
+            'labs/lab01/b.txt': 'b\n',
+            'labs/lab02/c.txt': 'c\n',
+        })
+
+        remotes = self.remotes
+
+        class Config(nbpuller_config.TestConfig):
+            COPY_PATH = os.path.join(self.root, 'home', '{username}')
+            GIT_URL_SCHEME = 'file'
+            ALLOWED_WEB_DOMAINS = [remotes]
+            REMOTE_FRESHNESS_TTL_S = 0
+
+        self.config = Config('/')
+        self.repo_dir = pfr.repo_dir_for(self.config, USERNAME, REPO, '')
+
+        self.strategies = []
+        choose_strategy = pfr._choose_strategy
+
+        def record(*args):
+            result = choose_strategy(*args)
+            self.strategies.append(result[0])
+            return result
+
+        patch = mock.patch.object(pfr, '_choose_strategy', record)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.pull()
+
+    def push(self, files):
+        """Commits files ({path: contents}) upstream."""
+        for path, contents in files.items():
+            full_path = os.path.join(self.upstream, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as upstream_file:
+                upstream_file.write(contents)
+        _git(self.upstream, 'add', '-A')
+        _git(self.upstream, 'commit', '-q', '-m', 'upstream')
+        _git(self.upstream, 'push', '-q', 'origin', BRANCH)
+        return _git(self.upstream, 'rev-parse', 'HEAD')
+
+    def pull(self):
+        message = pfr.pull_from_remote(
+            username=USERNAME,
+            repo_name=REPO,
+            branch_name=BRANCH,
+            paths=['labs/lab01'],
+            config=self.config,
+            progress=None,
+            notebook_path='',
+            account='',
+            domain=self.remotes,
+        )
+        self.assertNotEqual(message['type'], 'ERROR', message['payload'])
+        return self.strategies[-1] if self.strategies else None
+
+    def read(self, path):
+        with open(os.path.join(self.repo_dir, path)) as user_file:
+            return user_file.read()
+
+    def write(self, path, contents):
+        with open(os.path.join(self.repo_dir, path), 'w') as user_file:
+            user_file.write(contents)
+
+    def head(self):
+        return _git(self.repo_dir, 'rev-parse', 'HEAD')
+
+    def status(self):
+        return _git(self.repo_dir, 'status', '--porcelain')
+
+    def assertSparse(self):
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo_dir, 'labs/lab02')))
+
+    def wip_merge(self):
+        """Makes a WIP merge of a local change of a.txt."""
+        self.write('labs/lab01/a.txt', 'mine\n')
+        upstream = self.push({'labs/lab01/a.txt': 'theirs\n'})
+        self.assertEqual(self.pull(), pfr.WIP_MERGE)
+        return upstream
+
+    def test_up_to_date(self):
+        head = self.head()
+        self.write('labs/lab01/a.txt', 'mine\n')
+
+        self.assertEqual(self.pull(), pfr.UP_TO_DATE)
+        self.assertEqual(self.head(), head)
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+
+    def test_merge_fast_forwards_around_local_changes(self):
+        self.write('labs/lab01/a.txt', 'mine\n')
+        upstream = self.push({'labs/lab01/b.txt': 'new b\n'})
+
+        self.assertEqual(self.pull(), pfr.MERGE)
+        self.assertEqual(self.head(), upstream)
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+        self.assertEqual(self.read('labs/lab01/b.txt'), 'new b\n')
+        self.assertEqual(self.status(), 'M labs/lab01/a.txt')
+        self.assertSparse()
+
+    def test_wip_merge_keeps_local_changes(self):
+        upstream = self.wip_merge()
+
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+        self.assertEqual(self.status(), '')
+        self.assertEqual(
+            _git(self.repo_dir, 'log', '-1', '--format=%s', 'HEAD^1'), 'WIP')
+        self.assertEqual(_git(self.repo_dir, 'rev-parse', 'HEAD^2'),
+                         upstream)
+        self.assertSparse()
+
+    def test_reset_after_wip_merge(self):
+        self.wip_merge()
+        merged = self.head()
+        upstream = self.push({'labs/lab01/b.txt': 'new b\n'})
+
+        self.assertEqual(self.pull(), pfr.RESET)
+        self.assertEqual(self.head(), upstream)
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+        self.assertEqual(self.read('labs/lab01/b.txt'), 'new b\n')
+        self.assertEqual(self.status(), 'M labs/lab01/a.txt')
+        self.assertEqual(
+            _git(self.repo_dir, 'rev-parse', pfr.BACKUP_REF), merged)
+        self.assertSparse()
+
+        # Afterwards, pulls fast-forward again
+        upstream = self.push({'labs/lab01/b.txt': 'newer b\n'})
+        self.assertEqual(self.pull(), pfr.MERGE)
+        self.assertEqual(self.head(), upstream)
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+
+    def test_merge_when_local_commits_overlap(self):
+        self.wip_merge()
+        merged = self.head()
+        upstream = self.push({'labs/lab01/a.txt': 'theirs again\n'})
+
+        self.assertEqual(self.pull(), pfr.MERGE)
+        self.assertEqual(self.read('labs/lab01/a.txt'), 'mine\n')
+        self.assertEqual(_git(self.repo_dir, 'rev-parse', 'HEAD^1'), merged)
+        self.assertEqual(_git(self.repo_dir, 'rev-parse', 'HEAD^2'),
+                         upstream)
+        self.assertEqual(self.status(), '')
+        self.assertSparse()
+
+    def current_redirect(self):
+        self.config.GIT_REDIRECT_PATH = '/tree/{destination}'
+        self.config.REMOTE_FRESHNESS_TTL_S = 300
+        return pfr.current_redirect(
+            username=USERNAME,
+            repo_name=REPO,
+            branch_name=BRANCH,
+            paths=['labs/lab01/a.txt'],
+            config=self.config,
+            notebook_path='',
+            account='',
+            domain=self.remotes,
+        )
+
+    def test_current_redirect(self):
+        self.write('labs/lab01/a.txt', 'mine\n')
+        self.assertTrue(self.current_redirect().endswith(
+            '/assets/labs/lab01/a.txt'))
+
+    def test_current_redirect_after_upstream_change(self):
+        self.push({'labs/lab01/a.txt': 'theirs\n'})
+        # As if REMOTE_FRESHNESS_TTL_S had passed since the pull
+        pfr.remote_refs.forget(
+            pfr.remote_url(self.config, self.remotes, '', REPO), BRANCH)
+        self.assertIsNone(self.current_redirect())
+
+    def test_current_redirect_of_deleted_file(self):
+        os.unlink(os.path.join(self.repo_dir, 'labs/lab01/a.txt'))
+        self.assertIsNone(self.current_redirect())
+
+class OverlapsTest(unittest.TestCase):
+
+    def test_same_path(self):
+        self.assertTrue(pfr._overlaps(['a/b.txt'], ['a/b.txt']))
+
+    def test_directory_and_file_inside(self):
+        self.assertTrue(pfr._overlaps(['a'], ['a/b/c.txt']))
+        self.assertTrue(pfr._overlaps(['a/b/c.txt'], ['a/']))
+
+    def test_unrelated(self):
+        self.assertFalse(pfr._overlaps(['a/b.txt'], ['a/c.txt']))
+        self.assertFalse(pfr._overlaps(['ab/c.txt'], ['a']))
+        self.assertFalse(pfr._overlaps(['a/b.txt'], []))
+
+
+if __name__ == '__main__':
+    unittest.main()